@@ -5,23 +5,31 @@
 # DESCRIPTION: Classes for Aglient GPIB instruments
 # AUTHOR: Christopher Hall <hsw@openmoko.com>
 
-from Gpib import *
-from time import sleep
+from Scpi import *
+import time
 
 
-class DMM34401A(Gpib):
+class DMM34401A(Instrument):
+
+    # readings held by the internal memory
+    MEMORY_SIZE = 512
 
     def __init__(self, address = 22, gpib_card = 0):
-        Gpib.__init__(self, gpib_card, address)
+        Instrument.__init__(self, address, gpib_card)
         self.clear()
-        sleep(0.1)
+        self.waitComplete()
         self.write('*rst\n')
         self.write('*cls\n')
 
     def __del__(self):
-        sleep(0.1)
+        self.waitComplete()
         Gpib.__del__(self)
 
+    def reset(self):
+        """Quickly return to a known state without a full *rst"""
+        self.messageOff()
+        self.write('*cls\n')
+
     def setVoltageDC(self):
         self.write(':configure:voltage:dc def,def\n')
 
@@ -30,16 +38,62 @@ class DMM34401A(Gpib):
 
     @property
     def voltage(self):
-        self.write(':measure:voltage:dc?\n')
-        return float(self.read().strip('\r\n \t'))
+        return self.query(':measure:voltage:dc?')
 
     @property
     def current(self):
-        self.write(':measure:current:dc?\n')
-        return float(self.read().strip('\r\n \t'))
+        return self.query(':measure:current:dc?')
+
+    def startStatistics(self):
+        """Start collecting min/max/average of the following readings"""
+        self.write(':calculate:function average;:calculate:state on\n')
+
+    def statistics(self):
+        """Read the statistics collected since startStatistics in one transaction"""
+        return self.batch() \
+            .query('minimum', ':calculate:average:minimum?') \
+            .query('maximum', ':calculate:average:maximum?') \
+            .query('average', ':calculate:average:average?') \
+            .query('count', ':calculate:average:count?', lambda x: int(float(x))) \
+            .run()
+
+    def startAcquisition(self, count, nplc = 0.02, delay = 0):
+        """Start taking count readings into the internal memory
+
+        Uses the current function (see setVoltageDC, setCurrentDC) with
+        the given integration time (power line cycles) and delay
+        between readings.  The readings are collected with
+        fetchAcquisition."""
+        if count < 1 or count > self.MEMORY_SIZE:
+            raise ValueError('count must be 1..%d' % self.MEMORY_SIZE)
+        self.write(':zero:auto off;:trigger:source immediate;:trigger:delay %f;'
+                   ':sample:count %d\n' % (delay, count))
+        function = self.query(':configure?', lambda x: x.strip('\r\n \t"').split()[0])
+        self.write(':%s:nplc %s\n' % (function, nplc))
+        self.acquisition_count = count
+        self.acquisition_start = time.time()
+        self.write(':init\n')
+
+    def fetchAcquisition(self):
+        """Wait for the readings to complete and read them in one transfer
+
+        The time stamps are spread evenly between the start and the
+        completion of the acquisition."""
+        with self.lock:
+            self.query('*opc?')
+            end = time.time()
+            self.write(':fetch?\n')
+            values = numbers(self.read(16 * self.acquisition_count + 64))
+        return Readings(values, self.acquisition_start,
+                        (end - self.acquisition_start) / max(len(values), 1))
+
+    def acquire(self, count, nplc = 0.02, delay = 0):
+        """Take count readings at the fastest rate and return them"""
+        self.startAcquisition(count, nplc, delay)
+        return self.fetchAcquisition()
 
     def messageOff(self):
-        self.write(':display:window:text:state 0\n')
+        self.write(':display:text:clear\n')
 
 
 def main():
@@ -48,6 +102,11 @@ def main():
     #sleep(1)
     v = dmm.voltage
     print 'V = %7.3f V' % v
+    r = dmm.acquire(10)
+    print 'acquired %d readings' % len(r)
+    dmm.messageOff()
+    for e in dmm.errors():
+        print 'error:', e
 
 if __name__ == '__main__':
     main()
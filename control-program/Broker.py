@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# COPYRIGHT: Openmoko Inc. 2009
+# LICENSE: GPL Version 2 or later
+# DESCRIPTION: Instrument broker owning the GPIB cards and serial ports
+# AUTHOR: Openmoko Inc.
+
+# The broker process opens the GPIB instruments and serial ports on
+# behalf of its clients, which connect over a Unix socket.  A client
+# leases an instrument (or a port) for as long as its connection is
+# open; a second client asking for the same instrument waits until it
+# is released.  All requests for one GPIB card (or one serial port) are
+# queued and executed in order by a single thread, so several sequencer
+# processes can share the bench without colliding on the bus.
+#
+# Protocol: one JSON object per line in each direction, e.g.
+#   {"op": "open", "card": 0, "address": 5}  ->  {"ok": true}
+#   {"op": "write", "data": "*cls\n"}        ->  {"ok": true}
+#   {"op": "read", "length": 512}            ->  {"ok": true, "data": "..."}
+#   {"op": "timeout", "value": 9}            ->  {"ok": true}
+#   {"op": "serial", "port": "/dev/ttyUSB0", "baudrate": 19200, "timeout": 0.1}
+#   {"op": "in_waiting"}                     ->  {"ok": true, "count": 0}
+# errors are returned as {"ok": false, "error": "message"}.
+#
+# Clients: Gpib (used by Transport.py when GPIB_TRANSPORT=broker) and
+# Serial (used by RelayBoard for ports named broker:<port>).  Writes are
+# pipelined: they are sent without waiting and their replies are only
+# checked at the next read or other synchronous request.
+
+import sys
+import os
+import time
+import json
+import socket
+import getopt
+import threading
+import Queue
+
+
+DEFAULT_SOCKET = '/tmp/gpib-broker.socket'
+
+# how long to wait for a leased instrument to be released
+LEASE_TIMEOUT = 60
+
+
+class GpibError(Exception):
+    """An error reported by the broker"""
+    pass
+
+
+def encode(data):
+    """Bus data is bytes, carry it as latin-1 in JSON"""
+    return data.decode('latin-1')
+
+
+def decode(data):
+    return data.encode('latin-1')
+
+
+# ----------------------------------------------------------------------
+# server
+
+class Bus():
+    """A thread executing the operations for one GPIB card or port in order"""
+
+    def __init__(self):
+        self.work = Queue.Queue()
+        t = threading.Thread(target = self.worker)
+        t.setDaemon(True)
+        t.start()
+
+    def worker(self):
+        while True:
+            (function, result, done) = self.work.get()
+            try:
+                result.append((True, function()))
+            except Exception, e:
+                result.append((False, e))
+            done.set()
+
+    def call(self, function):
+        """Queue a function, wait for it and return its result"""
+        result = []
+        done = threading.Event()
+        self.work.put((function, result, done))
+        done.wait()
+        (ok, value) = result[0]
+        if not ok:
+            raise value
+        return value
+
+
+class Server():
+    """Owns the instruments and serves the clients"""
+
+    def __init__(self, path, backend):
+        self.path = path
+        if 'sim' == backend:
+            from SimGpib import Gpib
+        else:
+            from Gpib import Gpib
+        self.Gpib = Gpib
+        self.lock = threading.Condition()
+        self.buses = {}
+        self.devices = {}
+        self.leases = {}
+
+    def bus(self, key):
+        with self.lock:
+            if key not in self.buses:
+                self.buses[key] = Bus()
+            return self.buses[key]
+
+    def lease(self, key, client, create):
+        """Wait until no other client has the device, then take it"""
+        deadline = time.time() + LEASE_TIMEOUT
+        with self.lock:
+            while key in self.leases:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise GpibError('%s is in use' % (key,))
+                self.lock.wait(remaining)
+            self.leases[key] = client
+        try:
+            if key not in self.devices:
+                self.devices[key] = self.bus(key[:2]).call(create)
+        except:
+            self.release(key)
+            raise
+        return self.devices[key]
+
+    def release(self, key):
+        with self.lock:
+            del self.leases[key]
+            self.lock.notifyAll()
+
+    def run(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        listener.listen(16)
+        while True:
+            (connection, address) = listener.accept()
+            t = threading.Thread(target = self.serve, args = (connection,))
+            t.setDaemon(True)
+            t.start()
+
+    def serve(self, connection):
+        """Handle the requests of one client in order"""
+        stream = connection.makefile('r+b', 0)
+        key = None
+        device = None
+        try:
+            for line in stream:
+                request = json.loads(line)
+                try:
+                    reply = {'ok': True}
+                    op = request['op']
+                    if 'open' == op and key is None:
+                        card = request.get('card', 0)
+                        address = request['address']
+                        wanted = ('gpib', card, address)
+                        device = self.lease(wanted, connection,
+                                            lambda: self.Gpib(card, address))
+                        key = wanted
+                    elif 'serial' == op and key is None:
+                        wanted = ('serial', request['port'], None)
+                        device = self.lease(wanted, connection,
+                                            lambda: self.openSerial(request))
+                        key = wanted
+                    elif device is None:
+                        raise GpibError('nothing open')
+                    else:
+                        reply.update(self.bus(key[:2]).call(
+                                lambda: self.execute(device, op, request)))
+                except Exception, e:
+                    reply = {'ok': False, 'error': str(e)}
+                stream.write(json.dumps(reply) + '\n')
+        except (socket.error, ValueError):
+            pass
+        finally:
+            if key is not None:
+                self.release(key)
+            try:
+                stream.close()
+            except socket.error:
+                # the client went away with replies still buffered
+                pass
+            connection.close()
+
+    def openSerial(self, request):
+        from serial.serialposix import Serial
+        s = Serial(port = request['port'])
+        s.xonxoff = False
+        s.rtscts = False
+        s.baudrate = request.get('baudrate', 19200)
+        s.timeout = request.get('timeout', 0.1)
+        if not s.isOpen():
+            s.open()
+        return s
+
+    def execute(self, device, op, request):
+        """Perform one operation on a device, return the reply items"""
+        if 'write' == op:
+            device.write(decode(request['data']))
+        elif 'read' == op:
+            if 'size' in request:
+                return {'data': encode(device.read(request['size']))}
+            return {'data': encode(device.read(request.get('length', 512)))}
+        elif 'clear' == op:
+            device.clear()
+        elif 'timeout' == op:
+            device.timeout(request['value'])
+        elif 'in_waiting' == op:
+            return {'count': device.inWaiting()}
+        else:
+            raise GpibError('invalid operation: %s' % op)
+        return {}
+
+
+# ----------------------------------------------------------------------
+# clients
+
+class Connection():
+    """A client connection with pipelined requests"""
+
+    def __init__(self):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(os.environ.get('GPIB_BROKER', DEFAULT_SOCKET))
+        self.stream = self.socket.makefile('r+b', 0)
+        self.pending = 0
+
+    def send(self, **request):
+        """Send a request without waiting for its reply"""
+        self.stream.write(json.dumps(request) + '\n')
+        self.pending += 1
+
+    def reply(self):
+        line = self.stream.readline()
+        if '' == line:
+            raise GpibError('broker connection closed')
+        self.pending -= 1
+        return json.loads(line)
+
+    def request(self, **request):
+        """Send a request and return its reply
+
+        The replies to previously pipelined requests are checked
+        first and any error they reported is raised."""
+        self.send(**request)
+        error = None
+        while self.pending > 1:
+            r = self.reply()
+            if not r['ok'] and error is None:
+                error = r['error']
+        r = self.reply()
+        if error is not None:
+            raise GpibError(error)
+        if not r['ok']:
+            raise GpibError(r['error'])
+        return r
+
+    def close(self):
+        self.stream.close()
+        self.socket.close()
+
+
+class Gpib:
+    """Drop in replacement for Gpib.Gpib using the broker"""
+
+    def __init__(self, name = 0, pad = None, sad = 0, timeout = 13, send_eoi = 1, eos_mode = 0):
+        self.connection = Connection()
+        self.connection.request(op = 'open', card = name, address = pad)
+
+    def __del__(self):
+        self.connection.close()
+
+    def write(self, message):
+        self.connection.send(op = 'write', data = encode(message))
+
+    def read(self, len = 512):
+        return decode(self.connection.request(op = 'read', length = len)['data'])
+
+    def clear(self):
+        self.connection.request(op = 'clear')
+
+    def timeout(self, value):
+        self.connection.send(op = 'timeout', value = value)
+
+    def wait(self, mask):
+        pass
+
+
+class Serial():
+    """Enough of serial.Serial for RelayBoard, using the broker"""
+
+    def __init__(self, port = None):
+        self.port = port
+        self.xonxoff = False
+        self.rtscts = False
+        self.baudrate = 19200
+        self.bytesize = 8
+        self.parity = 'N'
+        self.stopbits = 1
+        self.timeout = None
+        self.connection = None
+
+    def open(self):
+        self.connection = Connection()
+        self.connection.request(op = 'serial', port = self.port,
+                                baudrate = self.baudrate, timeout = self.timeout)
+
+    def isOpen(self):
+        return self.connection is not None
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def write(self, data):
+        self.connection.send(op = 'write', data = encode(data))
+
+    def read(self, size = 1):
+        return decode(self.connection.request(op = 'read', size = size)['data'])
+
+    def inWaiting(self):
+        return self.connection.request(op = 'in_waiting')['count']
+
+
+# ----------------------------------------------------------------------
+
+# display error and usage message; then exit
+def usage(message):
+    if message != None:
+        print 'error:', message
+    print 'usage:', sys.argv[0], '<options>'
+    print '       --help        = this message'
+    print '       --socket=path = Unix socket to listen on (default: %s)' % DEFAULT_SOCKET
+    print '       --backend=gpib|sim'
+    print '                     = real instruments (default) or simulated ones'
+    sys.exit(1)
+
+
+def main():
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'hs:b:', ['help', 'socket=', 'backend='])
+    except getopt.GetoptError, err:
+        usage(err)
+    path = os.environ.get('GPIB_BROKER', DEFAULT_SOCKET)
+    backend = 'gpib'
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            usage(None)
+        elif o in ('-s', '--socket'):
+            path = a
+        elif o in ('-b', '--backend'):
+            if a not in ('gpib', 'sim'):
+                usage('invalid backend: ' + a)
+            backend = a
+        else:
+            usage('invalid option: ' + o)
+    if args != []:
+        usage('unexpected arguments')
+    Server(path, backend).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# Concurrent
+# -*- coding: utf-8 -*-
+# COPYRIGHT: Openmoko Inc. 2009
+# LICENSE: GPL Version 2 or later
+# DESCRIPTION: Run independent instrument operations at the same time
+# AUTHOR: Openmoko Inc.
+
+# Each instrument serialises its own SCPI transactions with a lock (see
+# Scpi.Instrument) so operations on different instruments can overlap
+# while those on one instrument never interleave.
+#
+# e.g.  (r, v) = parallel(lambda: psu.setVoltageMeasure(3), lambda: dmm.voltage)
+#
+# A pool thread works on behalf of the thread that submitted its
+# function: owner() identifies that thread and the CPU time used for
+# it is added up in cpu, so that time can be charged to the caller.
+
+import sys
+import thread
+import threading
+import resource
+import Queue
+
+
+# the Linux value, Python 2 does not name it
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', 1)
+
+context = threading.local()
+
+# owner thread id -> CPU seconds used by pool threads on its behalf
+cpu = {}
+cpu_lock = threading.Lock()
+
+
+def owner():
+    """Return the id of the thread the calling thread is working for
+
+    This is the submitting thread while a pool thread runs a function,
+    otherwise the calling thread itself."""
+    return getattr(context, 'owner', None) or thread.get_ident()
+
+
+def threadCpu():
+    """Return the CPU time used by the calling thread in seconds"""
+    r = resource.getrusage(RUSAGE_THREAD)
+    return r.ru_utime + r.ru_stime
+
+
+class Pool():
+    """A fixed set of worker threads running submitted functions"""
+
+    def __init__(self, size = 4):
+        self.work = Queue.Queue()
+        for i in range(size):
+            t = threading.Thread(target = self.worker)
+            t.setDaemon(True)
+            t.start()
+
+    def worker(self):
+        while True:
+            (function, results, index, done, caller) = self.work.get()
+            context.owner = caller
+            start = threadCpu()
+            try:
+                results[index] = (True, function())
+            except:
+                results[index] = (False, sys.exc_info())
+            context.owner = None
+            with cpu_lock:
+                cpu[caller] = cpu.get(caller, 0.0) + threadCpu() - start
+            done.release()
+
+    def run(self, *functions):
+        """Call all the functions concurrently and return their results
+
+        If any function raises an exception the first one (in argument
+        order) is raised again once all have finished."""
+        results = [None] * len(functions)
+        done = threading.Semaphore(0)
+        caller = owner()
+        for (index, function) in enumerate(functions):
+            self.work.put((function, results, index, done, caller))
+        for f in functions:
+            done.acquire()
+        values = []
+        for (ok, value) in results:
+            if not ok:
+                raise value[0], value[1], value[2]
+            values.append(value)
+        return values
+
+
+pool = None
+
+def parallel(*functions):
+    """Call the functions concurrently using a shared pool"""
+    global pool
+    if pool is None:
+        pool = Pool()
+    return pool.run(*functions)
@@ -5,36 +5,99 @@
 # DESCRIPTION: Classes for Keithley GPIB instruments
 # AUTHOR: Christopher Hall <hsw@openmoko.com>
 
-from Gpib import *
+from Scpi import *
 from time import sleep
+import time
 
 
-class PSU2303(Gpib):
+class PSU2303(Instrument):
 
-    def __init__(self, address = 5, gpib_card = 0):
-        Gpib.__init__(self, gpib_card, address)
+    # readings held by the internal buffer
+    BUFFER_SIZE = 5000
+    # shortest sample interval (seconds)
+    MINIMUM_INTERVAL = 33.3e-6
+
+    # queries to read back each cached setting
+    READBACK = {
+        'voltage': ':source:voltage:amplitude?',
+        'current': ':source:current:limit:value?',
+        'output': ':output?',
+        'display': ':display:window:text:state?',
+        }
+
+    def __init__(self, address = 5, gpib_card = 0, verify = False):
+        """verify = read back every setting actually sent (for debugging)"""
+        Instrument.__init__(self, address, gpib_card)
+        self.verify = verify
         self.clear()
-        sleep(0.1)
+        self.waitComplete()
         self.write('*rst\n')
+        self.state = {}
         self.write('*cls\n')
-        self.write(':display:window:text:state 0\n')
         self.powerOff()
         self.messageOff()
 
     def __del__(self):
         self.powerOff()
         self.messageOff()
-        sleep(0.25)
+        self.waitComplete()
         self.clear()
-        sleep(0.1)
         Gpib.__del__(self)
 
+    def clear(self):
+        """Device clear, this forgets all the cached settings"""
+        self.state = {}
+        Instrument.clear(self)
+
+    def setting(self, name, value, command):
+        """Send a setting unless the instrument already has that value"""
+        with self.lock:
+            if self.state.get(name) == value:
+                return
+            self.state.pop(name, None)
+            self.write(command)
+            self.state[name] = value
+            if self.verify:
+                self.verifySetting(name)
+
+    def verifySetting(self, name):
+        """Check a cached setting against the instrument"""
+        actual = self.query(self.READBACK[name])
+        if abs(actual - self.state[name]) > 1e-3:
+            raise ScpiError('%s is %g, expected %g' % (name, actual, self.state[name]))
+
+    def reset(self):
+        """Quickly return to a safe state: output off and errors cleared"""
+        self.powerOff()
+        self.messageOff()
+        self.write('*cls\n')
+
     def setVoltage(self, v, max = 4):
         if v < 0:
             v = 0
         elif v > max:
             v = max
-        self.write(':source:voltage:amplitude %f\n' % v)
+        self.setting('voltage', round(v, 6), ':source:voltage:amplitude %f\n' % v)
+
+    def setVoltageMeasure(self, v, max = 4):
+        """Set the voltage then measure voltage and current in one transaction"""
+        if v < 0:
+            v = 0
+        elif v > max:
+            v = max
+        with self.lock:
+            b = self.batch()
+            if self.state.get('voltage') != round(v, 6):
+                self.state.pop('voltage', None)
+                b.command(':source:voltage:amplitude %f' % v)
+            r = b.query('voltage', ':measure:voltage:dc?') \
+                .query('current', ':measure:current:dc?') \
+                .run()
+            if 'voltage' not in self.state:
+                self.state['voltage'] = round(v, 6)
+                if self.verify:
+                    self.verifySetting('voltage')
+        return r
 
 
     def setCurrent(self, i, max = 1):
@@ -42,40 +105,80 @@ class PSU2303(Gpib):
             i = 0.01
         elif i > max:
             i = max
-        self.write(':source:current:limit:value %f\n' % i)
+        self.setting('current', round(i, 6), ':source:current:limit:value %f\n' % i)
 
     def powerOff(self):
-        self.write(':output off\n')
+        self.setting('output', 0, ':output off\n')
 
     def powerOn(self):
-        self.write(':output on\n')
+        self.setting('output', 1, ':output on\n')
 
     def settings(self):
-        self.write(':source:voltage:amplitude?\n')
-        print 'Vs   = %7.3f V' % float(self.read().strip('\r\n \t'))
-        self.write(':source:current:limit:value?\n')
-        print 'Ilim = %7.3f mA' % (float(self.read().strip('\r\n \t')) * 1000)
+        r = self.batch() \
+            .query('voltage', ':source:voltage:amplitude?') \
+            .query('current', ':source:current:limit:value?') \
+            .run()
+        print 'Vs   = %7.3f V' % r.voltage
+        print 'Ilim = %7.3f mA' % (r.current * 1000)
 
     def measure(self):
-        print 'V = %7.3f V' % self.voltage
-        print 'I = %7.3f mA' % (self.current * 1000)
+        r = self.measureVI()
+        print 'V = %7.3f V' % r.voltage
+        print 'I = %7.3f mA' % (r.current * 1000)
+
+    def measureVI(self):
+        """Measure output voltage and current in one transaction"""
+        return self.batch() \
+            .query('voltage', ':measure:voltage:dc?') \
+            .query('current', ':measure:current:dc?') \
+            .run()
 
     @property
     def voltage(self):
-        self.write(':measure:voltage:dc?\n')
-        return float(self.read().strip('\r\n \t'))
+        return self.query(':measure:voltage:dc?')
 
     @property
     def current(self):
-        self.write(':measure:current:dc?\n')
-        return float(self.read().strip('\r\n \t'))
+        return self.query(':measure:current:dc?')
+
+    def startCurrentAcquisition(self, count, interval = None):
+        """Start sampling the output current into the internal buffer
+
+        count readings are taken interval seconds apart (None = the
+        fastest rate, 33.3 us).  The readings are collected with
+        fetchAcquisition, no other queries may be sent in between."""
+        if count < 1 or count > self.BUFFER_SIZE:
+            raise ValueError('count must be 1..%d' % self.BUFFER_SIZE)
+        if interval is None:
+            interval = self.MINIMUM_INTERVAL
+        interval = max(interval, self.MINIMUM_INTERVAL)
+        self.write(':sense:function "current";:sense:sweep:points %d;'
+                   ':sense:sweep:tinterval %g\n' % (count, interval))
+        self.acquisition_interval = interval
+        self.acquisition_count = count
+        self.acquisition_start = time.time()
+        self.write(':read:array?\n')
+
+    def fetchAcquisition(self):
+        """Read all the samples of the acquisition in one transfer"""
+        values = numbers(self.read(16 * self.acquisition_count + 64))
+        return Readings(values, self.acquisition_start, self.acquisition_interval)
+
+    def acquireCurrent(self, count, interval = None):
+        """Sample the output current and return the readings"""
+        self.startCurrentAcquisition(count, interval)
+        return self.fetchAcquisition()
 
     def message(self, text):
-        self.write(':display:window:text:data "%s"\n' % text)
-        self.write(':display:window:text:state 1\n')
+        with self.lock:
+            if self.state.get('text') != text:
+                self.state.pop('text', None)
+                self.write(':display:window:text:data "%s"\n' % text)
+                self.state['text'] = text
+        self.setting('display', 1, ':display:window:text:state 1\n')
 
     def messageOff(self):
-        self.write(':display:window:text:state 0\n')
+        self.setting('display', 0, ':display:window:text:state 0\n')
 
 
 def main():
@@ -88,6 +191,9 @@ def main():
     psu.settings()
     psu.measure()
     psu.powerOff()
+    psu.messageOff()
+    for e in psu.errors():
+        print 'error:', e
 
 
 if __name__ == '__main__':
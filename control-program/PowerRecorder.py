@@ -0,0 +1,187 @@
+# PowerRecorder
+# -*- coding: utf-8 -*-
+# COPYRIGHT: Openmoko Inc. 2009
+# LICENSE: GPL Version 2 or later
+# DESCRIPTION: Record the PSU output current in the background
+# AUTHOR: Openmoko Inc.
+
+# A thread samples the current of a PSU2303 into a ring buffer while
+# the test runs; the test then asks about a time window instead of
+# polling the supply itself.  Each sample is a query holding the
+# instrument lock (see Scpi.Instrument) so the test can still use the
+# supply; with block set the supply's own buffer is used to take
+# bursts of readings at a precise interval.
+#
+# e.g.
+#   recorder = PowerRecorder.PowerRecorder(psu)
+#   recorder.start()
+#   ...
+#   lost = recorder.watch(100, 0.01)
+#   assert [] == lost, 'lost power'
+#   recorder.stop()
+#   recorder.save('boot-power.npy')
+#
+# In a test script saveTrace keeps the trace of each board in the
+# station's trace_dir, if it has one.
+
+import os
+import time
+import threading
+import numpy
+
+from Scpi import Result
+
+
+class PowerRecorder():
+    """Ring buffer of (time, current) samples from a power supply
+
+    If file_name is given the buffer is a memory mapped file so that
+    the trace survives the process."""
+
+    def __init__(self, psu, size = 100000, interval = 0.01, block = None, file_name = None):
+        self.psu = psu
+        self.size = size
+        self.interval = interval
+        self.block = block
+        if file_name is None:
+            self.buffer = numpy.zeros((size, 2))
+        else:
+            self.buffer = numpy.memmap(file_name, dtype = numpy.float64,
+                                       mode = 'w+', shape = (size, 2))
+        self.count = 0
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.error = None
+        self.start_time = None
+
+    def start(self):
+        """Start sampling in a background thread"""
+        if self.thread is not None:
+            return
+        self.start_time = time.time()
+        self.stopping.clear()
+        self.thread = threading.Thread(target = self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop sampling, the samples remain available"""
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if isinstance(self.buffer, numpy.memmap):
+            self.buffer.flush()
+
+    def run(self):
+        try:
+            while not self.stopping.isSet():
+                if self.block is None:
+                    t = time.time()
+                    self.append([t], [self.psu.current])
+                    # wait for the rest of the interval; an event rather
+                    # than sleep so it is not counted as test time blocked
+                    delay = t + self.interval - time.time()
+                    if delay > 0:
+                        self.stopping.wait(delay)
+                else:
+                    # keep the start and fetch together
+                    with self.psu.lock:
+                        r = self.psu.acquireCurrent(self.block, self.interval)
+                    self.append(r.times, r.values)
+        except Exception, e:
+            self.error = e
+
+    def append(self, times, values):
+        """Add samples to the ring, overwriting the oldest"""
+        n = len(values)
+        with self.lock:
+            positions = numpy.arange(self.count, self.count + n) % self.size
+            self.buffer[positions, 0] = times
+            self.buffer[positions, 1] = values
+            self.count += n
+
+    def samples(self, start = None, end = None):
+        """Return (times, currents) arrays in time order
+
+        start and end are absolute times (time.time()); None means
+        from the first or up to the last sample held"""
+        if self.error is not None:
+            raise self.error
+        with self.lock:
+            if self.count <= self.size:
+                data = self.buffer[:self.count].copy()
+            else:
+                first = self.count % self.size
+                data = numpy.concatenate((self.buffer[first:], self.buffer[:first]))
+        times = data[:, 0]
+        selected = numpy.ones(len(times), dtype = bool)
+        if start is not None:
+            selected &= times >= start
+        if end is not None:
+            selected &= times < end
+        return (times[selected], data[selected, 1])
+
+    def window(self, start = None, end = None):
+        """Return the statistics of a time window
+
+        result has count, min, max and mean (None if there are no samples)"""
+        (times, current) = self.samples(start, end)
+        r = Result(count = len(current), min = None, max = None, mean = None)
+        if len(current) > 0:
+            r.update(min = current.min(), max = current.max(), mean = current.mean())
+        return r
+
+    def brownouts(self, threshold, start = None, end = None):
+        """Return [(start, end)] of the periods the current was below threshold
+
+        the magnitude of the current is compared; end is the time of
+        the first sample that recovered (None if it has not)"""
+        (times, current) = self.samples(start, end)
+        low = numpy.abs(current) < threshold
+        # indices where the state changes
+        edges = numpy.flatnonzero(numpy.diff(low.astype(int))) + 1
+        if len(low) > 0 and low[0]:
+            edges = numpy.concatenate(([0], edges))
+        result = []
+        for i in range(0, len(edges), 2):
+            if i + 1 < len(edges):
+                result.append((times[edges[i]], times[edges[i + 1]]))
+            else:
+                result.append((times[edges[i]], None))
+        return result
+
+    def watch(self, duration, threshold, poll = 0.5):
+        """Wait for duration seconds, returning early on a brownout
+
+        returns the brownouts seen, see brownouts()"""
+        start = time.time()
+        end = start + duration
+        while True:
+            lost = self.brownouts(threshold, start)
+            now = time.time()
+            if [] != lost or now >= end:
+                return lost
+            time.sleep(min(poll, end - now))
+
+    def save(self, file_name):
+        """Write the samples, in time order, as a numpy array of (time, current) rows"""
+        (times, current) = self.samples()
+        numpy.save(file_name, numpy.column_stack((times, current)))
+
+    def saveTrace(self, station, module, board, run_id, pass_number):
+        """Save the samples in the station's trace_dir, if it has one
+
+        The file is power-<module>-<board>-<run id>-<pass>.npy where
+        module is the base name of the test script and board is the
+        station number if no board was given.  Returns the file name
+        or None."""
+        if 'trace_dir' not in station:
+            return None
+        if board is None:
+            board = 'station%d' % station['number']
+        file_name = os.path.join(station['trace_dir'], 'power-%s-%s-%s-%d.npy' %
+                                 (os.path.basename(module), board, run_id, pass_number))
+        self.save(file_name)
+        return file_name
@@ -6,19 +6,67 @@
 # AUTHOR: Christopher Hall <hsw@openmoko.com>
 
 from serial.serialposix import *
-from time import sleep
+from time import sleep, time
+import sys
+import os
+import ctypes
+import ctypes.util
+
+
+class RelayError(Exception):
+    pass
+
+
+CLOCK_MONOTONIC = 1
+
+class timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+try:
+    librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno = True)
+    clock_gettime = librt.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+except (OSError, AttributeError):
+    clock_gettime = None
+
+
+def monotonic():
+    """Seconds from an arbitrary start, unaffected by changes to the date
+
+    falls back to time() if clock_gettime is not available"""
+    if clock_gettime is None:
+        return time()
+    t = timespec()
+    if 0 != clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(t)):
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return t.tv_sec + t.tv_nsec * 1e-9
+
+
+def frame(map):
+    """The command setting all the relays to a map"""
+    return '{%04x}' % (map & 0xffff)
 
 
 class RelayBoard():
 
     def __init__(self, port = '/dev/ttyUSB0', bps = 19200, timeout = 0.1):
-        self.relay = Serial(port = port)
+        """port may be broker:<device> to share the port through Broker.py"""
+        if port.startswith('broker:'):
+            import Broker
+            self.relay = Broker.Serial(port = port[len('broker:'):])
+        else:
+            self.relay = Serial(port = port)
         self.relay.xonxoff = False
         self.relay.rtscts = False
         self.relay.baudrate = bps
         self.relay.timeout = timeout
+        self.now = None
+        # time allowed for a frame to be echoed: ten bits per character
+        self.deadline = 1.0 + 10.0 * len('{0000}') / bps
         print self.relay.baudrate, self.relay.bytesize, self.relay.parity, self.relay.stopbits
-        self.relay.open()
+        if not self.relay.isOpen():
+            self.relay.open()
         self.allOff()
 
     def __del__(self):
@@ -26,19 +74,54 @@ class RelayBoard():
 
     def allOff(self):
         """Swich off all realays immediately"""
-        self.now = 0
         self.map = 0
-        self.update()
+        self.update(force = True)
+
+    def update(self, force = False):
+        """Set relay pending state to current state
 
-    def update(self):
-        """Set relay pending state to current state"""
-        s = '{%04x}' % (self.map & 0xffff)
+        The frame is sent in a single write and the echo read back in
+        bulk.  Nothing is sent if the relays are already in the pending
+        state, unless force is set."""
+        if self.map == self.now and not force:
+            return
+        self.send(frame(self.map))
         self.now = self.map
-        for c in s:
-            self.relay.write(c)
-            while 0 == self.relay.inWaiting():
-                sleep(0.001)
-            self.relay.read(1)
+
+    def send(self, s):
+        """Write a frame and wait for its echo"""
+        self.relay.write(s)
+        echo = ''
+        deadline = time() + self.deadline
+        while len(echo) < len(s):
+            echo += self.relay.read(len(s) - len(echo))
+            if len(echo) < len(s) and time() > deadline:
+                raise RelayError('relay board timeout, echo: %r' % echo)
+        if echo != s:
+            raise RelayError('relay board echo: %r expected: %r' % (echo, s))
+
+    def sequence(self, steps, spin = 0.002):
+        """Play a list of (offset in seconds, relay map) steps
+
+        The frames are prepared in advance and each is sent when its
+        offset from the start is reached on the monotonic clock; the
+        last spin seconds of each wait are busy waited to reduce
+        jitter.  Returns a list of (scheduled, actual) times relative
+        to the start, actual being when the echo of the frame was
+        complete."""
+        frames = [(offset, map & 0xffff, frame(map)) for (offset, map) in sorted(steps)]
+        timing = []
+        start = monotonic()
+        for (offset, map, s) in frames:
+            delay = start + offset - monotonic()
+            if delay > spin:
+                sleep(delay - spin)
+            while monotonic() < start + offset:
+                pass
+            self.send(s)
+            self.map = self.now = map
+            timing.append((offset, monotonic() - start))
+        return timing
 
     def state(self):
         """Return the state of the relays"""
@@ -62,17 +145,21 @@ class RelayBoard():
 
     def on(self, n):
         """Turn relay on (and update pending relays)"""
-        self.set(n):
+        self.set(n)
         self.update();
 
     def off(self, n):
         """Turn relay off (and update pending relays)"""
-        self.clear(n):
+        self.clear(n)
         self.update();
 
 
 def main():
-    r = RelayBoard()
+    # optional port, e.g. the one printed by RelaySim.py
+    if len(sys.argv) > 1:
+        r = RelayBoard(port = sys.argv[1])
+    else:
+        r = RelayBoard()
     r.set(4)
     r.set(7)
     r.update()
@@ -80,12 +167,18 @@ def main():
     r.allOff()
     sleep(0.1)
 
+    start = time()
     for x in range(5):
         for i in range(1, 17):
             r.set(i)
             r.update()
             sleep(0.02)
             r.clear(i)
+    print 'scan: %.3f s' % (time() - start)
+
+    steps = [(0.01 * i, 1 << (i % 16)) for i in range(50)] + [(0.5, 0)]
+    for (scheduled, actual) in r.sequence(steps):
+        print 'scheduled: %.4f  actual: %.4f  late: %+.4f' % (scheduled, actual, actual - scheduled)
 
     r = None
 
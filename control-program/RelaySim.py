@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# COPYRIGHT: Openmoko Inc. 2009
+# LICENSE: GPL Version 2 or later
+# DESCRIPTION: Simulated serial relay board on a pseudo terminal
+# AUTHOR: Openmoko Inc.
+
+# The simulator opens a pseudo terminal and behaves like the relay
+# board on its master side: every byte received is echoed back after
+# the time it would take at the configured baud rate, and each
+# complete {xxxx} frame sets the state of the sixteen relays.
+# RelayBoard is pointed at the slave side, e.g.
+#
+#   sim = RelaySim.RelaySim(bps = 19200)
+#   sim.start()
+#   r = RelayBoard.RelayBoard(port = sim.port)
+
+import sys
+import os
+import pty
+import tty
+import time
+import select
+import getopt
+import threading
+
+
+class RelaySim():
+    """Relay board model serving one pseudo terminal"""
+
+    def __init__(self, bps = 19200):
+        (self.master, self.slave) = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        # ten bits per character: start, eight data and stop
+        if bps:
+            self.byte_time = 10.0 / bps
+        else:
+            self.byte_time = 0
+        self.state = 0
+        self.frame = None
+        # (time, state) for each frame received
+        self.history = []
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = False
+
+    def __del__(self):
+        self.stop()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def start(self):
+        """Serve the port in a background thread"""
+        self.running = True
+        self.thread = threading.Thread(target = self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        # time the line is next free to send an echo
+        free = time.time()
+        while self.running:
+            (r, w, x) = select.select([self.master], [], [], 0.1)
+            if [] == r:
+                continue
+            received = time.time()
+            for c in os.read(self.master, 1024):
+                # each byte takes one character time to arrive and then
+                # queues behind any echo still being sent
+                received += self.byte_time
+                free = max(free, received) + self.byte_time
+                delay = free - time.time()
+                if delay > 0:
+                    select.select([], [], [], delay)
+                os.write(self.master, c)
+                self.receive(c)
+
+    def receive(self, c):
+        """Parse one byte of the relay protocol"""
+        if '{' == c:
+            self.frame = ''
+        elif self.frame is None:
+            self.errors += 1
+        elif '}' == c:
+            try:
+                if 4 != len(self.frame):
+                    raise ValueError
+                value = int(self.frame, 16)
+            except ValueError:
+                self.errors += 1
+            else:
+                with self.lock:
+                    self.state = value
+                    self.history.append((time.time(), value))
+            self.frame = None
+        else:
+            self.frame += c
+
+    def relay(self, n):
+        """Return True if relay n (1..16) is on"""
+        return 0 != self.state & (1 << (n - 1))
+
+
+# display error and usage message; then exit
+def usage(message):
+    if message != None:
+        print 'error:', message
+    print 'usage:', sys.argv[0], '<options>'
+    print '       --help        = this message'
+    print '       --bps=rate    = baud rate to simulate, 0 for no delay (default: 19200)'
+    sys.exit(1)
+
+
+def main():
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'hb:', ['help', 'bps='])
+    except getopt.GetoptError, err:
+        usage(err)
+    bps = 19200
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            usage(None)
+        elif o in ('-b', '--bps'):
+            try:
+                bps = int(a)
+            except ValueError:
+                usage('invalid baud rate: ' + a)
+        else:
+            usage('invalid option: ' + o)
+
+    sim = RelaySim(bps)
+    print 'relay board on:', sim.port
+    sys.stdout.flush()
+    sim.start()
+    seen = 0
+    try:
+        while True:
+            time.sleep(0.1)
+            with sim.lock:
+                changes = sim.history[seen:]
+                seen = len(sim.history)
+            for (t, state) in changes:
+                print '%.3f %s' % (t, ''.join(['01'[(state >> i) & 1] for i in range(16)]))
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        sim.stop()
+
+
+if __name__ == '__main__':
+    main()
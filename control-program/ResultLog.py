@@ -0,0 +1,38 @@
+# ResultLog
+# -*- coding: utf-8 -*-
+# COPYRIGHT: Openmoko Inc. 2009
+# LICENSE: GPL Version 2 or later
+# DESCRIPTION: Append only JSON Lines stream of test results
+# AUTHOR: Openmoko Inc.
+
+import os
+import time
+import json
+
+
+class ResultLog():
+    """Write one JSON object per line for each result
+
+    The file is opened in append mode and every record is written with
+    a single unbuffered write, so several processes can share one log
+    and a collector can tail it while the tests are running."""
+
+    def __init__(self, file_name, **fields):
+        self.fd = os.open(file_name, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        self.fields = fields
+
+    def __del__(self):
+        self.close()
+
+    def write(self, **items):
+        """Append a record, the fixed fields and a time stamp are added"""
+        record = dict(self.fields)
+        record['time'] = time.time()
+        record.update(items)
+        os.write(self.fd, json.dumps(record, sort_keys = True) + '\n')
+
+    def close(self):
+        """Close the log"""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# COPYRIGHT: Openmoko Inc. 2009
+# LICENSE: GPL Version 2 or later
+# DESCRIPTION: SQLite store for test results from many boards and runs
+# AUTHOR: Openmoko Inc.
+
+import sys
+import math
+import json
+import getopt
+import sqlite3
+
+
+# the fields of a result record, as written to the JSON Lines stream
+FIELDS = ['run', 'board', 'station', 'module', 'test', 'step', 'type',
+          'verdict', 'name', 'value', 'unit', 'message', 'start', 'end', 'time']
+
+SCHEMA = """
+create table if not exists results (
+    id integer primary key,
+    run text,
+    board text,
+    station integer,
+    module text,
+    test text,
+    step text,
+    type text,
+    verdict text,
+    name text,
+    value real,
+    unit text,
+    message text,
+    start real,
+    end real,
+    time real
+);
+create index if not exists results_board on results (board, time);
+create index if not exists results_test on results (test, time);
+create index if not exists results_module on results (module, type, time);
+create index if not exists results_station on results (station, time);
+create index if not exists results_time on results (time);
+create index if not exists results_name on results (name, time);
+"""
+
+
+class ResultStore():
+    """Local database of test results
+
+    Records are buffered and inserted in batches, each batch in a
+    single transaction.  The database uses write ahead logging and a
+    long busy timeout so that several station processes can write to
+    the same file at once."""
+
+    def __init__(self, file_name, batch_size = 200, timeout = 60):
+        self.db = sqlite3.connect(file_name, timeout = timeout)
+        self.db.execute('pragma journal_mode = wal')
+        self.db.execute('pragma synchronous = normal')
+        self.db.executescript(SCHEMA)
+        self.batch_size = batch_size
+        self.pending = []
+
+    def __del__(self):
+        self.close()
+
+    def add(self, record):
+        """Queue a result record (a dictionary) for insertion"""
+        row = []
+        for f in FIELDS:
+            value = record.get(f)
+            if f == 'value' and value is not None:
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    value = None
+            elif f in ('board', 'step') and value is not None:
+                value = str(value)
+            row.append(value)
+        self.pending.append(row)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write all queued records"""
+        if [] == self.pending:
+            return
+        self.db.executemany('insert into results (%s) values (%s)' %
+                            (', '.join(FIELDS), ', '.join(['?'] * len(FIELDS))),
+                            self.pending)
+        self.db.commit()
+        self.pending = []
+
+    def close(self):
+        """Write all queued records and close the database"""
+        if self.db is None:
+            return
+        self.flush()
+        self.db.close()
+        self.db = None
+
+    def importLog(self, file_name, **fields):
+        """Add all the records from a JSON Lines result log
+
+        fields supplies values for missing items, e.g. board"""
+        f = open(file_name)
+        try:
+            for line in f:
+                line = line.strip()
+                if '' == line:
+                    continue
+                record = dict(fields)
+                record.update(json.loads(line))
+                # older tests.Test logs only name the script in 'test'
+                if 'module' not in record and 'test' in record:
+                    record['module'] = record['test']
+                self.add(record)
+        finally:
+            f.close()
+        self.flush()
+
+    def where(self, conditions, board = None, station = None, since = None, until = None):
+        """Build a where clause and its parameters from the common filters"""
+        params = []
+        for (column, op, value) in [('board', '=', board), ('station', '=', station),
+                                    ('time', '>=', since), ('time', '<', until)]:
+            if value is not None:
+                conditions.append('%s %s ?' % (column, op))
+                params.append(value)
+        return (' where ' + ' and '.join(conditions), params)
+
+    def testYield(self, module = None, **filters):
+        """Return [(module, passed, total, yield)] for whole test scripts"""
+        conditions = ["type in ('module', 'test')"]
+        if module is not None:
+            conditions.append('module = ?')
+        (clause, params) = self.where(conditions, **filters)
+        if module is not None:
+            params.insert(0, module)
+        rows = self.db.execute('select module, sum(verdict = \'PASS\'), count(*) '
+                               'from results' + clause +
+                               ' group by module order by module', params)
+        return [(m, p, n, float(p) / n) for (m, p, n) in rows]
+
+    def stepFailureRate(self, module = None, **filters):
+        """Return [(test, failed, total, rate)] worst first"""
+        conditions = ["type = 'step'"]
+        if module is not None:
+            conditions.append('module = ?')
+        (clause, params) = self.where(conditions, **filters)
+        if module is not None:
+            params.insert(0, module)
+        rows = self.db.execute('select test, sum(verdict != \'PASS\'), count(*) '
+                               'from results' + clause +
+                               ' group by test', params)
+        result = [(t, f, n, float(f) / n) for (t, f, n) in rows]
+        result.sort(key = lambda r: (-r[3], r[0]))
+        return result
+
+    def moduleHistory(self, **filters):
+        """Return {module: (failure rate, mean duration in seconds)}
+
+        Every module record that ran counts towards the failure rate;
+        the duration is averaged over the records that have times
+        (None if none do)."""
+        (clause, params) = self.where(["type = 'module'", "verdict != 'SKIP'"], **filters)
+        rows = self.db.execute('select module, avg(verdict != \'PASS\'), avg(end - start) '
+                               'from results' + clause + ' group by module', params)
+        return dict([(m, (f, d)) for (m, f, d) in rows])
+
+    def measurements(self, name, module = None, **filters):
+        """Return all the values recorded for a measurement"""
+        conditions = ["type = 'measure'", 'name = ?', 'value is not null']
+        if module is not None:
+            conditions.append('module = ?')
+        (clause, params) = self.where(conditions, **filters)
+        params[0:0] = [name] + ([module] if module is not None else [])
+        return [v for (v,) in self.db.execute('select value from results' + clause, params)]
+
+    def distribution(self, name, bins = 10, **filters):
+        """Return statistics and a histogram for a measurement
+
+        result is a dictionary: count, min, max, mean, stddev and
+        histogram, a list of (lower bound, count)"""
+        values = self.measurements(name, **filters)
+        if [] == values:
+            return None
+        n = len(values)
+        low = min(values)
+        high = max(values)
+        mean = sum(values) / n
+        stddev = math.sqrt(sum([(v - mean) ** 2 for v in values]) / n)
+        width = (high - low) / bins
+        counts = [0] * bins
+        for v in values:
+            if 0 == width:
+                i = 0
+            else:
+                i = min(int((v - low) / width), bins - 1)
+            counts[i] += 1
+        return {
+            'count': n,
+            'min': low,
+            'max': high,
+            'mean': mean,
+            'stddev': stddev,
+            'histogram': [(low + i * width, counts[i]) for i in range(bins)],
+            }
+
+
+# display error and usage message; then exit
+def usage(message):
+    if message != None:
+        print 'error:', message
+    print 'usage:', sys.argv[0], '<options> <database> <command> [args]'
+    print '       --help        = this message'
+    print '       --board=serial = board serial for imported records without one'
+    print '       --module=name = restrict a query to one test module'
+    print 'commands:'
+    print '       import <file.jsonl>...  = add result logs to the database'
+    print '       yield                   = pass rate of each test module'
+    print '       failures                = failure rate of each test step'
+    print '       measure <name>          = distribution of a measured value'
+    sys.exit(1)
+
+
+def main():
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'hb:m:', ['help', 'board=', 'module='])
+    except getopt.GetoptError, err:
+        usage(err)
+    board = None
+    module = None
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            usage(None)
+        elif o in ('-b', '--board'):
+            board = a
+        elif o in ('-m', '--module'):
+            module = a
+        else:
+            usage('invalid option: ' + o)
+
+    if len(args) < 2:
+        usage('missing arguments')
+
+    store = ResultStore(args[0])
+    command = args[1]
+    if 'import' == command:
+        fields = {}
+        if board is not None:
+            fields['board'] = board
+        for name in args[2:]:
+            store.importLog(name, **fields)
+    elif 'yield' == command:
+        for (m, passed, total, ratio) in store.testYield(module, board = board):
+            print '%-40s %6d/%-6d %6.1f%%' % (m, passed, total, 100 * ratio)
+    elif 'failures' == command:
+        for (t, failed, total, rate) in store.stepFailureRate(module, board = board):
+            print '%-50s %6d/%-6d %6.1f%%' % (t, failed, total, 100 * rate)
+    elif 'measure' == command and 3 == len(args):
+        d = store.distribution(args[2], module = module, board = board)
+        if d is None:
+            print 'no values for:', args[2]
+        else:
+            print 'count = %d  min = %g  max = %g  mean = %g  stddev = %g' % \
+                (d['count'], d['min'], d['max'], d['mean'], d['stddev'])
+            for (low, count) in d['histogram']:
+                print '%12g %6d' % (low, count)
+    else:
+        usage('invalid command: ' + command)
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
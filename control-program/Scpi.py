@@ -0,0 +1,171 @@
+# Scpi
+# -*- coding: utf-8 -*-
+# COPYRIGHT: Openmoko Inc. 2009
+# LICENSE: GPL Version 2 or later
+# DESCRIPTION: Common base for SCPI instruments and batched queries
+# AUTHOR: Openmoko Inc.
+
+from Transport import Gpib, GpibError
+import array
+import time
+import threading
+
+
+# maximum length of a reply
+READ_SIZE = 4096
+
+# linux-gpib timeout codes: the default (T10s) and the one used while
+# polling for completion (T100ms)
+DEFAULT_TIMEOUT = 13
+POLL_TIMEOUT = 9
+
+
+class ScpiError(Exception):
+    """The instrument reply does not match the query"""
+    pass
+
+
+def number(reply):
+    """Convert a numeric reply"""
+    return float(reply.strip('\r\n \t'))
+
+
+def numbers(reply):
+    """Convert a comma separated list of numbers"""
+    reply = reply.strip('\r\n \t')
+    if '' == reply:
+        return []
+    return [float(x) for x in reply.split(',')]
+
+
+class Readings():
+    """A block of readings taken at a fixed interval
+
+    values is a compact array of the readings and times the matching
+    array of time stamps (seconds since the epoch)"""
+
+    def __init__(self, values, start, interval):
+        self.values = array.array('d', values)
+        self.start = start
+        self.interval = interval
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def times(self):
+        return array.array('d', [self.start + i * self.interval
+                                 for i in range(len(self.values))])
+
+
+class Result(dict):
+    """The replies to a batch, items are also available as attributes"""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class Batch():
+    """Several commands and queries sent as a single SCPI message
+
+    e.g. psu.batch().query('v', ':measure:voltage:dc?').query('i', ':measure:current:dc?').run()
+    returns a Result with r.v and r.i"""
+
+    def __init__(self, instrument):
+        self.instrument = instrument
+        self.commands = []
+        self.queries = []
+
+    def command(self, command):
+        """Add a command that has no reply"""
+        self.commands.append(command)
+        return self
+
+    def query(self, name, command, convert = number):
+        """Add a query, its converted reply is stored under name"""
+        self.commands.append(command)
+        self.queries.append((name, convert))
+        return self
+
+    def run(self):
+        """Send the message and return the Result"""
+        result = Result()
+        with self.instrument.lock:
+            self.instrument.write(';'.join(self.commands) + '\n')
+            if [] == self.queries:
+                return result
+            reply = self.instrument.read(READ_SIZE)
+        replies = reply.strip('\r\n \t').split(';')
+        if len(replies) != len(self.queries):
+            raise ScpiError('expected %d replies, got: %s' % (len(self.queries), ';'.join(replies)))
+        for ((name, convert), reply) in zip(self.queries, replies):
+            result[name] = convert(reply)
+        return result
+
+
+class Instrument(Gpib):
+    """Base class for SCPI instruments on a GPIB card
+
+    Each write, and each query with its reply, is done holding the
+    instrument's lock so that several threads can share an instrument."""
+
+    def __init__(self, address, gpib_card = 0):
+        self.lock = threading.RLock()
+        Gpib.__init__(self, gpib_card, address)
+
+    def write(self, message):
+        with self.lock:
+            Gpib.write(self, message)
+
+    def query(self, command, convert = number):
+        """Send a query and return its converted reply"""
+        with self.lock:
+            self.write(command + '\n')
+            reply = self.read(READ_SIZE)
+        return convert(reply)
+
+    def batch(self):
+        """Start a new batch of commands and queries"""
+        return Batch(self)
+
+    def errors(self):
+        """Read and clear the error queue, return the errors as strings"""
+        result = []
+        with self.lock:
+            while True:
+                error = self.query(':system:error?', lambda x: x.strip('\r\n \t'))
+                if error.split(',')[0] in ('0', '+0'):
+                    return result
+                result.append(error)
+
+    def waitComplete(self, timeout = 5):
+        """Wait until the instrument has finished all pending operations
+
+        *opc? is only answered once everything before it is complete.
+        An instrument that is still busy (e.g. just after a device
+        clear) and does not answer is polled again with an increasing
+        delay until the timeout.  The bus timeout is shortened while
+        polling so that an unanswered poll does not take the full
+        default timeout."""
+        deadline = time.time() + timeout
+        delay = 0.005
+        with self.lock:
+            self.timeout(POLL_TIMEOUT)
+            try:
+                while True:
+                    try:
+                        if 1 == self.query('*opc?'):
+                            return
+                    except (GpibError, ValueError):
+                        if time.time() + delay > deadline:
+                            raise
+                    else:
+                        if time.time() + delay > deadline:
+                            raise ScpiError('*opc? did not return 1 within %g s' % timeout)
+                    time.sleep(delay)
+                    delay = min(2 * delay, 0.1)
+            finally:
+                self.timeout(DEFAULT_TIMEOUT)
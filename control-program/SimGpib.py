@@ -0,0 +1,381 @@
+# SimGpib
+# -*- coding: utf-8 -*-
+# COPYRIGHT: Openmoko Inc. 2009
+# LICENSE: GPL Version 2 or later
+# DESCRIPTION: Simulated GPIB instruments for running without hardware
+# AUTHOR: Openmoko Inc.
+
+# Replaces the Gpib class from linux-gpib with in-process models of the
+# Keithley 2303 power supply and the Agilent 34401A multimeter.  The
+# models only understand the SCPI subset used by Keithley.py and
+# Agilent.py.
+#
+# Environment:
+#   GPIB_SIM_DEVICES  address:model,...  (default: 5:psu2303,7:psu2303,22:dmm34401a)
+#   GPIB_SIM_LATENCY  seconds added to every read and write (default: 0)
+#   GPIB_SIM_LOAD     load resistance in ohms on the PSU output (default: 20)
+
+import os
+import select
+import random
+
+
+DEFAULT_DEVICES = '5:psu2303,7:psu2303,22:dmm34401a'
+
+latency = float(os.environ.get('GPIB_SIM_LATENCY', '0'))
+
+
+def delay():
+    """Simulate the bus latency
+
+    select is used rather than time.sleep so that the delay is not
+    mistaken for a sleep in a test script"""
+    if latency > 0:
+        select.select([], [], [], latency)
+
+
+class GpibError(Exception):
+    """Same role as gpib.GpibError"""
+    pass
+
+
+def shortForm(keyword):
+    """Reduce a SCPI keyword to its short form
+
+    A keyword of up to four characters is its own short form;
+    otherwise it is the first four characters, or three if the
+    fourth is a vowel."""
+    keyword = keyword.lower()
+    if len(keyword) > 4:
+        keyword = keyword[:4]
+        if keyword[3] in 'aeiou':
+            keyword = keyword[:3]
+    return keyword
+
+
+def splitUnits(message):
+    """Split a SCPI message into its ';' separated units, respecting quotes"""
+    units = []
+    current = ''
+    quoted = False
+    for c in message:
+        if '"' == c:
+            quoted = not quoted
+        if ';' == c and not quoted:
+            units.append(current)
+            current = ''
+        else:
+            current += c
+    units.append(current)
+    return [u.strip() for u in units if '' != u.strip()]
+
+
+def parseUnit(unit):
+    """Return the normalised header and the argument string of a unit
+
+    e.g. ':SOURce:VOLTage:AMPLitude 2.5' -> ('sour:volt:ampl', '2.5')"""
+    parts = unit.split(None, 1)
+    header = parts[0]
+    if len(parts) > 1:
+        argument = parts[1].strip()
+    else:
+        argument = ''
+    query = header.endswith('?')
+    if query:
+        header = header[:-1]
+    if header.startswith('*'):
+        header = header.lower()
+    else:
+        header = ':'.join([shortForm(k) for k in header.strip(':').split(':')])
+    if query:
+        header += '?'
+    return (header, argument)
+
+
+def onOff(argument):
+    return argument.strip().lower() in ('1', 'on')
+
+
+def formatNumber(value):
+    return '%+.8E' % value
+
+
+class Device():
+    """An instrument model
+
+    Subclasses map normalised headers to methods in self.commands;
+    a method takes the argument string and returns the reply for a
+    query or None for a command."""
+
+    identity = 'SIMULATED,DEVICE,0,0'
+
+    def __init__(self):
+        self.output = ''
+        self.scripts = {}
+        self.commands = {
+            '*rst': self.reset,
+            '*cls': self.clearStatus,
+            '*opc': lambda a: None,
+            '*opc?': lambda a: '1',
+            '*idn?': lambda a: self.identity,
+            '*ese': lambda a: None,
+            '*sre': lambda a: None,
+            '*stb?': lambda a: '0',
+            'syst:err?': self.nextError,
+            }
+        self.reset('')
+        self.clearStatus('')
+
+    def reset(self, argument):
+        pass
+
+    def clearStatus(self, argument):
+        self.errors = []
+
+    def nextError(self, argument):
+        if [] == self.errors:
+            return '+0,"No error"'
+        return self.errors.pop(0)
+
+    def script(self, query, replies):
+        """Give fixed replies to a query, in order, before using the model"""
+        (header, argument) = parseUnit(query)
+        self.scripts.setdefault(header, []).extend(replies)
+
+    def write(self, message):
+        replies = []
+        for unit in splitUnits(message):
+            (header, argument) = parseUnit(unit)
+            if self.scripts.get(header):
+                replies.append(self.scripts[header].pop(0))
+                continue
+            function = self.commands.get(header)
+            if function is None:
+                self.errors.append('-113,"Undefined header"')
+                continue
+            try:
+                reply = function(argument)
+            except ValueError:
+                self.errors.append('-224,"Illegal parameter value"')
+                continue
+            if reply is not None:
+                replies.append(reply)
+        if [] != replies:
+            self.output = ';'.join(replies) + '\n'
+
+    def read(self, length):
+        if '' == self.output:
+            raise GpibError('read() error: Timeout')
+        reply = self.output[:length]
+        self.output = self.output[length:]
+        return reply
+
+    def clear(self):
+        self.output = ''
+
+
+class PSU2303(Device):
+    """Keithley 2303 power supply with a resistive load"""
+
+    identity = 'KEITHLEY INSTRUMENTS INC.,MODEL 2303,0000000,SIM'
+
+    def __init__(self):
+        Device.__init__(self)
+        self.load = float(os.environ.get('GPIB_SIM_LOAD', '20'))
+        self.commands.update({
+                'sour:volt:ampl': self.setVoltage,
+                'sour:volt:ampl?': lambda a: formatNumber(self.voltage),
+                'sour:curr:lim:val': self.setCurrentLimit,
+                'sour:curr:lim:val?': lambda a: formatNumber(self.current_limit),
+                'outp': self.setOutput,
+                'outp?': lambda a: str(int(self.output_on)),
+                'meas:volt:dc?': lambda a: formatNumber(self.measuredVoltage()),
+                'meas:curr:dc?': lambda a: formatNumber(self.measuredCurrent()),
+                'disp:wind:text:stat': self.setDisplay,
+                'disp:wind:text:stat?': lambda a: str(int(self.display)),
+                'disp:wind:text:data': self.setText,
+                'sens:func': lambda a: None,
+                'sens:swe:poin': self.setPoints,
+                'sens:swe:tint': self.setInterval,
+                'read:arr?': self.readArray,
+                })
+
+    def reset(self, argument):
+        self.voltage = 0.0
+        self.current_limit = 0.25
+        self.output_on = False
+        self.display = False
+        self.text = ''
+        self.points = 1
+        self.interval = 33.3e-6
+
+    def setVoltage(self, argument):
+        self.voltage = float(argument)
+
+    def setCurrentLimit(self, argument):
+        self.current_limit = float(argument)
+
+    def setOutput(self, argument):
+        self.output_on = onOff(argument)
+
+    def setDisplay(self, argument):
+        self.display = onOff(argument)
+
+    def setText(self, argument):
+        self.text = argument.strip('"')
+
+    def setPoints(self, argument):
+        self.points = int(float(argument))
+
+    def setInterval(self, argument):
+        self.interval = float(argument)
+
+    def measuredCurrent(self):
+        if not self.output_on:
+            return random.gauss(0, 1e-6)
+        return min(self.voltage / self.load, self.current_limit) + random.gauss(0, 1e-5)
+
+    def measuredVoltage(self):
+        if not self.output_on:
+            return 0.0
+        # current limited
+        return min(self.voltage, self.current_limit * self.load) + random.gauss(0, 1e-4)
+
+    def readArray(self, argument):
+        return ','.join([formatNumber(self.measuredCurrent()) for i in range(self.points)])
+
+
+class DMM34401A(Device):
+    """Agilent 34401A multimeter probing the output of the first PSU"""
+
+    identity = 'HEWLETT-PACKARD,34401A,0,SIM'
+
+    def __init__(self, card):
+        self.card = card
+        Device.__init__(self)
+        self.commands.update({
+                'conf:volt:dc': lambda a: self.setFunction('VOLT'),
+                'conf:curr:dc': lambda a: self.setFunction('CURR'),
+                'conf?': lambda a: '"%s +1.000000E+01,+3.000000E-06"' % self.function,
+                'meas:volt:dc?': lambda a: self.measure('VOLT'),
+                'meas:curr:dc?': lambda a: self.measure('CURR'),
+                'read?': lambda a: self.measure(self.function),
+                'volt:nplc': lambda a: None,
+                'curr:nplc': lambda a: None,
+                'zero:auto': lambda a: None,
+                'trig:sour': lambda a: None,
+                'trig:del': lambda a: None,
+                'samp:coun': self.setCount,
+                'init': self.initiate,
+                'fetc?': self.fetch,
+                'calc:func': lambda a: None,
+                'calc:stat': self.setStatistics,
+                'calc:aver:min?': lambda a: formatNumber(min(self.statistics or [0])),
+                'calc:aver:max?': lambda a: formatNumber(max(self.statistics or [0])),
+                'calc:aver:aver?': lambda a: formatNumber(sum(self.statistics or [0]) /
+                                                          max(len(self.statistics or []), 1)),
+                'calc:aver:coun?': lambda a: formatNumber(len(self.statistics or [])),
+                'disp:text:cle': lambda a: None,
+                })
+
+    def reset(self, argument):
+        self.function = 'VOLT'
+        self.count = 1
+        self.memory = []
+        self.statistics = None
+
+    def setFunction(self, function):
+        self.function = function
+
+    def setCount(self, argument):
+        self.count = int(float(argument))
+
+    def setStatistics(self, argument):
+        if onOff(argument):
+            self.statistics = []
+        else:
+            self.statistics = None
+
+    def source(self):
+        """The supply the meter is connected to"""
+        for ((card, address), device) in sorted(devices.items()):
+            if card == self.card and isinstance(device, PSU2303):
+                return device
+        return None
+
+    def reading(self, function):
+        psu = self.source()
+        if psu is None:
+            value = random.gauss(0, 1e-6)
+        elif 'CURR' == function:
+            value = psu.measuredCurrent()
+        else:
+            value = psu.measuredVoltage()
+        if self.statistics is not None:
+            self.statistics.append(value)
+        return value
+
+    def measure(self, function):
+        self.function = function
+        return formatNumber(self.reading(function))
+
+    def initiate(self, argument):
+        self.memory = [self.reading(self.function) for i in range(self.count)]
+
+    def fetch(self, argument):
+        return ','.join([formatNumber(v) for v in self.memory])
+
+
+MODELS = {
+    'psu2303': lambda card: PSU2303(),
+    'dmm34401a': lambda card: DMM34401A(card),
+    }
+
+# shared device state: (card, address) -> Device
+devices = {}
+
+
+def device(card, address):
+    """Return the device model at an address, creating it if necessary"""
+    key = (card, address)
+    if key not in devices:
+        for item in os.environ.get('GPIB_SIM_DEVICES', DEFAULT_DEVICES).split(','):
+            (a, model) = item.split(':')
+            if int(a) == address:
+                devices[key] = MODELS[model.strip().lower()](card)
+                break
+        else:
+            raise GpibError('no simulated device at address %d' % address)
+    return devices[key]
+
+
+def script(card, address, query, replies):
+    """Make the device at an address give fixed replies to a query"""
+    device(card, address).script(query, replies)
+
+
+class Gpib:
+    """Drop in replacement for Gpib.Gpib talking to a simulated device"""
+
+    def __init__(self, name = 0, pad = None, sad = 0, timeout = 13, send_eoi = 1, eos_mode = 0):
+        self.device = device(name, pad)
+
+    def __del__(self):
+        pass
+
+    def write(self, message):
+        delay()
+        self.device.write(message)
+
+    def read(self, len = 512):
+        delay()
+        return self.device.read(len)
+
+    def clear(self):
+        self.device.clear()
+
+    def timeout(self, value):
+        pass
+
+    def wait(self, mask):
+        pass
@@ -0,0 +1,111 @@
+# Sweep
+# -*- coding: utf-8 -*-
+# COPYRIGHT: Openmoko Inc. 2009
+# LICENSE: GPL Version 2 or later
+# DESCRIPTION: Voltage sweeps with limits checked over the whole curve
+# AUTHOR: Openmoko Inc.
+
+# e.g.
+#   r = Sweep.sweep(psu, 2.0, 3.45, 0.05, dmm = dmm,
+#                   limits = {'current': (-0.001, 0.001)})
+#   assert r.ok, 'Leakage current too high at %s V' % r.setpoints[~r.passed]
+
+import numpy
+from time import sleep
+
+from Concurrent import parallel
+
+
+class SweepResult():
+    """The measured curve of a sweep
+
+    setpoints, voltage and current (and dmm, if a meter was used) are
+    arrays with one element per point; passed is a boolean array that
+    is True where every limit was met."""
+
+    def __init__(self, setpoints, readings):
+        self.setpoints = setpoints
+        self.names = sorted(readings.keys())
+        for name in self.names:
+            setattr(self, name, readings[name])
+        self.passed = numpy.ones(len(setpoints), dtype = bool)
+
+    def __len__(self):
+        return len(self.setpoints)
+
+    def check(self, name, low = None, high = None):
+        """Apply a limit to one of the readings
+
+        low and high may be None, a number, an array with a value for
+        each point or a function of the setpoints array.  If the sweep
+        stopped early only the first part of an array is used."""
+        values = getattr(self, name)
+        for (limit, compare) in [(low, numpy.greater_equal), (high, numpy.less_equal)]:
+            if limit is None:
+                continue
+            if callable(limit):
+                limit = limit(self.setpoints)
+            limit = numpy.asarray(limit)
+            if limit.ndim > 0:
+                limit = limit[:len(values)]
+            self.passed &= compare(values, limit)
+        return self
+
+    @property
+    def ok(self):
+        """True if all points passed"""
+        return bool(self.passed.all())
+
+    def failures(self):
+        """Return the setpoints of the points that failed"""
+        return self.setpoints[~self.passed]
+
+    def table(self):
+        """Return the curve as rows of (setpoint, readings..., passed)"""
+        return zip(self.setpoints, *([getattr(self, n) for n in self.names] + [self.passed]))
+
+
+def sweep(psu, start, stop, step, dmm = None, settle = 0, limits = None, stop_on_fail = False):
+    """Step the PSU voltage from start to stop (inclusive) and measure
+
+    At each point the PSU output voltage and current, and the DMM
+    reading if a meter is given, are recorded.  settle is a delay
+    between setting the voltage and measuring.  limits is a dictionary
+    of reading name -> (low, high), see SweepResult.check.  With
+    stop_on_fail the sweep ends at the first point outside the limits
+    and the result only holds the points up to that one."""
+    setpoints = numpy.arange(start, stop + step / 2.0, step)
+    voltage = numpy.empty(len(setpoints))
+    current = numpy.empty(len(setpoints))
+    readings = {'voltage': voltage, 'current': current}
+    if dmm is not None:
+        meter = numpy.empty(len(setpoints))
+        readings['dmm'] = meter
+
+    def result(count):
+        r = SweepResult(setpoints[:count],
+                        dict([(n, a[:count]) for (n, a) in readings.iteritems()]))
+        if limits is not None:
+            for (name, (low, high)) in limits.iteritems():
+                r.check(name, low, high)
+        return r
+
+    count = len(setpoints)
+    for (i, v) in enumerate(setpoints):
+        if settle > 0:
+            psu.setVoltage(v)
+            sleep(settle)
+            measure = psu.measureVI
+        else:
+            measure = lambda: psu.setVoltageMeasure(v)
+        if dmm is None:
+            r = measure()
+        else:
+            (r, meter[i]) = parallel(measure, lambda: dmm.voltage)
+        voltage[i] = r.voltage
+        current[i] = r.current
+        if stop_on_fail and limits is not None and not result(i + 1).passed[i]:
+            count = i + 1
+            break
+
+    return result(count)
@@ -5,29 +5,34 @@
 # DESCRIPTION: Sample test
 # AUTHOR: Christopher Hall <hsw@openmoko.com>
 
-import Keithley
-import Agilent
-from time import sleep
+from time import sleep, time
+import PowerRecorder
+import Sweep
 
 psu = None
 dmm = None
+recorder = None
 
 def setUp():
     """Set up power supply and turn on
 
        Also put a message on the PSU LCD to warn operator"""
-    global psu, dmm
+    global psu, dmm, recorder
 
     if debug:
         print 'setUp: **initialising**'
 
-    dmm = Agilent.DMM34401A(22)
+    dmm = session.dmm()
     dmm.setVoltageDC()
 
-    psu = Keithley.PSU2303(7)
+    # the station's supply, e.g. psu=7 in the station config for the
+    # bench this test was written for
+    psu = session.psu()
     psu.setCurrent(0.25)
     psu.setVoltage(0)
     psu.powerOn()
+    recorder = PowerRecorder.PowerRecorder(psu)
+    recorder.start()
     if debug:
         psu.settings()
         psu.measure()
@@ -35,15 +40,18 @@ def setUp():
 
 def tearDown():
     """Shutdown the power supply"""
-    global psu, dmm, debug
+    global psu, dmm, recorder, debug
     psu.setCurrent(0)
     psu.setVoltage(0)
     psu.powerOff()
+    if recorder is not None:
+        recorder.stop()
+        # keep the boot power trace of each board
+        recorder.saveTrace(station, __name__, board, run_id, pass_number)
+    recorder = None
     psu.messageOff()
     if debug:
         print 'tearDown: **cleanup**'
-    del psu
-    del dmm
     psu = None
     dmm = None
 
@@ -54,15 +62,13 @@ def testZzz():
 def test001_leakage():
     """Make sure power is off and no leakage"""
     global psu, dmm
-    voltage = 2.0
-    for i in range(30):
-        psu.setVoltage(voltage)
-        voltage += 0.05
-        i = psu.current
-        assert abs(i) < 0.001, "Leakage current too high"
-        info('V = %7.3f' % dmm.voltage)
-        sleep(0.05)
+    r = Sweep.sweep(psu, 2.0, 3.45, 0.05, dmm = dmm, settle = 0.05,
+                    limits = {'current': (-0.001, 0.001)}, stop_on_fail = True)
     psu.setVoltage(0)
+    for (setpoint, v) in zip(r.setpoints, r.dmm):
+        info('V = %7.3f' % v)
+    measure('leakage', abs(r.current).max(), 'A')
+    assert r.ok, "Leakage current too high at %s V" % r.failures()
 
 def test002_on():
     """Step voltage and read back"""
@@ -82,10 +88,13 @@ def test002_on():
 
 def test003_check_booted():
     """How to find out if booted?"""
-    global psu
-    for i in range(1000):
-        if debug:
-            psu.measure()
-        sleep(0.1)
-        i = psu.current
-        assert abs(i) > 0.01, "Device failed - lost power?"
+    global recorder
+    start = time()
+    lost = recorder.watch(100, 0.01)
+    w = recorder.window(start)
+    if debug:
+        print 'I: min = %.3f mA  max = %.3f mA  mean = %.3f mA  (%d samples)' % \
+            (w.min * 1000, w.max * 1000, w.mean * 1000, w.count)
+    measure('boot_current_min', w.min, 'A')
+    measure('boot_current_mean', w.mean, 'A')
+    assert [] == lost, "Device failed - lost power at %.1f s?" % (lost[0][0] - start)
@@ -11,10 +11,75 @@ import os.path
 import getopt
 import inspect
 import textwrap
+import multiprocessing
+import StringIO
+import marshal
+import imp
+import time
+import thread
+import json
+import cProfile
+import socket
+
+import ResultLog
+import ResultStore
+import Concurrent
 
 
 DIRECTORY_IGNORE_LIST = ['CVS', '.svn', '.git', '00IGNORE']
 
+# the fixture used when no station configuration is given
+station = {'number': 1}
+
+# the instruments shared by the test scripts run on this station
+session = None
+
+# compiled test scripts: path -> ((mtime, size), code)
+code_cache = {}
+cache_hits = 0
+cache_misses = 0
+
+# timing records for each step run, None if timing is disabled
+timing = None
+
+# time blocked on instruments and sleep during the current step
+# only calls made by the thread running the step, or by Concurrent
+# pool threads working for it, are counted; not those of background
+# threads such as a PowerRecorder.  Parallel calls are each counted
+# so the total can exceed the wall time
+blocked = {'gpib_read': 0.0, 'gpib_write': 0.0, 'sleep': 0.0}
+blocked_lock = thread.allocate_lock()
+step_thread = None
+
+# identifies this run of the sequencer in the results
+run_id = None
+
+# board serial number for the results (a station may override this)
+board = None
+
+# JSON Lines result stream, None if not required
+result_log = None
+
+# result database, each station process opens its own connection
+result_database = None
+result_store = None
+current_module = None
+current_step = None
+
+# script path -> name relative to the directory it was found in
+# scripts given on the command line are known by their base name
+module_paths = {}
+
+# what to do when a test fails: continue, module, board or station
+on_fail = 'module'
+
+# the repeat pass being run
+current_pass = 0
+
+# directory for per module profile dumps, None if profiling is disabled
+profile_dir = None
+profiles = {}
+
 
 # display a functions documentation string
 def displayDoc(message):
@@ -23,29 +88,269 @@ def displayDoc(message):
 
 def info(x):
     print 'INFO:', x
+    logResult(type = 'info', message = str(x))
+
+# record a measured value
+def measure(name, value, unit = None):
+    if unit is None:
+        print 'INFO: %s = %s' % (name, value)
+    else:
+        print 'INFO: %s = %s %s' % (name, value, unit)
+    logResult(type = 'measure', name = name, value = value, unit = unit)
+
+# add a record to the result log and database
+def logResult(**items):
+    if result_log is None and result_store is None:
+        return
+    items['station'] = station['number']
+    b = station.get('board', board)
+    if b is not None:
+        items['board'] = b
+    if current_module is not None:
+        items.setdefault('module', current_module)
+        items.setdefault('step', current_step)
+        if current_step is None:
+            items.setdefault('test', current_module)
+        else:
+            items.setdefault('test', '%s.%s' % (current_module, current_step))
+    if result_log is not None:
+        result_log.write(**items)
+    if result_store is not None:
+        items['run'] = run_id
+        items.setdefault('time', time.time())
+        result_store.add(items)
+
+# open the result database for this process
+def openStore():
+    global result_store
+    if result_database is not None:
+        result_store = ResultStore.ResultStore(result_database)
+
+# write any pending results and close the database
+def closeStore():
+    global result_store
+    if result_store is not None:
+        result_store.close()
+        result_store = None
+
+
+class Session():
+    """Instruments shared by all the test scripts run on one station
+
+    Each instrument is opened and initialised once, on first use, and
+    is then handed to every test script that asks for it.  Between
+    test scripts the instruments are only reset to a safe state."""
+
+    def __init__(self, fixture, verify = False):
+        self.station = fixture
+        self.verify = verify
+        self.instruments = {}
+
+    def open(self, kind, address, create):
+        """Return the shared instrument, creating it if necessary"""
+        key = (kind, self.station.get('gpib_card', 0), address)
+        if key not in self.instruments:
+            self.instruments[key] = create(address, key[1])
+        return self.instruments[key]
+
+    def psu(self, address = None):
+        """Return the station's power supply"""
+        import Keithley
+        if address is None:
+            address = self.station.get('psu', 5)
+        return self.open('psu', address,
+                         lambda address, card: Keithley.PSU2303(address, card, self.verify))
+
+    def dmm(self, address = None):
+        """Return the station's multimeter"""
+        import Agilent
+        if address is None:
+            address = self.station.get('dmm', 22)
+        return self.open('dmm', address, Agilent.DMM34401A)
+
+    def reset(self):
+        """Put all open instruments back into a safe state"""
+        for instrument in self.instruments.itervalues():
+            instrument.reset()
+
+    def close(self):
+        """Close all instruments"""
+        self.instruments = {}
+
+# return the code object for a test script
+# it is only recompiled if its modification time or size has changed
+def compileTest(name):
+    global cache_hits, cache_misses
+    st = os.stat(name)
+    key = (st.st_mtime, st.st_size)
+    entry = code_cache.get(name)
+    if entry is not None and entry[0] == key:
+        cache_hits += 1
+        return entry[1]
+    cache_misses += 1
+    f = open(name, 'rU')
+    try:
+        source = f.read()
+    finally:
+        f.close()
+    code = compile(source, name, 'exec')
+    code_cache[name] = (key, code)
+    return code
+
+# load a previously saved code cache
+# a missing file or one from a different Python version is ignored
+def loadCache(file_name):
+    global code_cache
+    try:
+        f = open(file_name, 'rb')
+    except IOError:
+        return
+    try:
+        try:
+            (magic, entries) = marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+            return
+    finally:
+        f.close()
+    if magic == imp.get_magic():
+        code_cache = entries
+
+# save the code cache
+def saveCache(file_name):
+    temp_name = file_name + '.tmp'
+    f = open(temp_name, 'wb')
+    try:
+        marshal.dump((imp.get_magic(), code_cache), f)
+    finally:
+        f.close()
+    os.rename(temp_name, file_name)
+
+# display the code cache statistics
+def cacheReport():
+    total = cache_hits + cache_misses
+    if 0 == total:
+        return
+    print 'CACHE: %d hits, %d misses (%.1f%% hit rate)' % \
+        (cache_hits, cache_misses, 100.0 * cache_hits / total)
+
+# wrap a function to add the time spent in it to a blocked category
+def blockingCall(category, function):
+    def wrapper(*args, **kwargs):
+        if Concurrent.owner() != step_thread:
+            return function(*args, **kwargs)
+        start = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            with blocked_lock:
+                blocked[category] += time.time() - start
+    return wrapper
+
+# measure the time spent in sleep and GPIB transfers
+# this must be done before the instrument modules are imported
+def installTimingHooks():
+    time.sleep = blockingCall('sleep', time.sleep)
+    try:
+        import Transport
+    except ImportError:
+        return
+    Transport.Gpib.read = blockingCall('gpib_read', Transport.Gpib.read)
+    Transport.Gpib.write = blockingCall('gpib_write', Transport.Gpib.write)
+
+# CPU time used by the step's thread and the pool threads working for it
+def stepCpu():
+    return Concurrent.threadCpu() + Concurrent.cpu.get(step_thread, 0.0)
+
+# run one function from a test script recording its timing and result
+def runStep(module_name, step, global_variables):
+    global current_step, step_thread
+    current_step = step
+    step_thread = thread.get_ident()
+    for category in blocked:
+        blocked[category] = 0.0
+    start = time.time()
+    cpu = stepCpu()
+    verdict = 'ERROR'
+    message = None
+    try:
+        eval(step + '()', global_variables)
+        verdict = 'PASS'
+    except AssertionError, e:
+        verdict = 'FAIL'
+        message = str(e)
+        raise
+    except Exception, e:
+        message = str(e)
+        raise
+    finally:
+        end = time.time()
+        logResult(type = 'step', verdict = verdict, message = message,
+                  start = start, end = end)
+        if timing is not None:
+            record = {
+                'station': station['number'],
+                'module': module_name,
+                'step': step,
+                'start': start,
+                'wall': end - start,
+                'cpu': stepCpu() - cpu,
+                }
+            record.update(blocked)
+            timing.append(record)
+
+# write the timing records as JSON
+def saveTiming(file_name):
+    f = open(file_name, 'w')
+    try:
+        json.dump(timing, f, indent = 1)
+    finally:
+        f.close()
+
+# profile one test script
+# the statistics accumulate if the script is run more than once
+def profileTests(name, debug):
+    profile = profiles.get(name)
+    if profile is None:
+        profile = cProfile.Profile()
+        profiles[name] = profile
+    profile.enable()
+    try:
+        return runTests(name, debug)
+    finally:
+        profile.disable()
+        base_name = os.path.splitext(os.path.basename(name))[0]
+        profile.dump_stats(os.path.join(profile_dir, '%s.%d.prof' %
+                                        (base_name, station['number'])))
 
 # the main script running application
 # this can throw exceptions if compile or setUp fail
 # If setUp succeeds the tearDown will be run
+# returns the verdict: PASS or FAIL
 def runTests(name, debug):
-    global verbose
+    global verbose, current_module, current_step
 
-    module_name = name
-    if name.endswith('.py'):
-        module_name = name[:-3]
-    elif name.endswith('.pyc'):
-        module_name = name[:-4]
+    module_name = moduleName(name)
+    current_module = module_name
+    current_step = None
+    module_start = time.time()
 
     if verbose:
         print 'TEST: Load Module:', module_name
 
     global_variables = {
+        '__name__': module_name,
         'debug': debug,
         'info': lambda x : info(x),
+        'measure': measure,
+        'station': station,
+        'session': session,
+        'board': station.get('board', board),
+        'run_id': run_id,
+        'pass_number': current_pass,
         }
     eval('0', global_variables) # populate global_variables
 
-    execfile(name, global_variables)
+    exec compileTest(name) in global_variables
 
     s = filter(lambda name: name.startswith('test'), global_variables.iterkeys())
     s.sort()
@@ -54,39 +359,103 @@ def runTests(name, debug):
         print 'TEST: Run: %s.setUp' % module_name
         displayDoc(inspect.getdoc(global_variables['setUp']))
 
-    eval('setUp()', global_variables)
+    runStep(module_name, 'setUp', global_variables)
 
+    verdict = 'PASS'
     try:
         for f in s:
             if verbose:
                 print 'TEST: Run: %s.%s' % (module_name, f)
                 displayDoc(inspect.getdoc(global_variables[f]))
-            eval(f + '()', global_variables)
-        if verbose:
+            try:
+                runStep(module_name, f, global_variables)
+            except AssertionError, e:
+                if 'continue' != on_fail:
+                    raise
+                print 'FAIL:', e
+                verdict = 'FAIL'
+        if verbose and 'PASS' == verdict:
             print 'PASS: all tests completed'
     except AssertionError, e:
         print 'FAIL:', e
+        verdict = 'FAIL'
     finally:
         if verbose:
             print 'TEST: Run: %s.tearDown' % module_name
             displayDoc(inspect.getdoc(global_variables['tearDown']))
-        eval('tearDown()', global_variables)
+        runStep(module_name, 'tearDown', global_variables)
+    current_step = None
+    logResult(type = 'module', verdict = verdict,
+              start = module_start, end = time.time())
+    return verdict
 
 
 # run one test script catching errors
+# returns the verdict: PASS, FAIL or ERROR
 def runOneTest(name, debug):
+    global current_module, current_step
     if verbose:
         print 'TEST: %s' % name
+    verdict = 'ERROR'
+    module_start = time.time()
     try:
-        runTests(name, debug)
+        if profile_dir is None:
+            verdict = runTests(name, debug)
+        else:
+            verdict = profileTests(name, debug)
     except SyntaxError, s:
         print 'Test module compile failed: ', s
+        current_step = None
+        logResult(type = 'module', verdict = 'ERROR', message = str(s),
+                  start = module_start, end = time.time())
     except Exception, e:
         print 'Test module run failed', e
+        current_step = None
+        logResult(type = 'module', verdict = 'ERROR', message = str(e),
+                  start = module_start, end = time.time())
+    finally:
+        try:
+            session.reset()
+        except Exception, e:
+            print 'Session reset failed', e
+        current_module = None
+        current_step = None
+        if result_store is not None:
+            result_store.flush()
+    return verdict
+
+
+# report a test script that was not run
+def skipTest(name, reason):
+    print 'INFO: skipped %s: %s' % (name, reason)
+    logResult(type = 'module', module = moduleName(name), test = moduleName(name),
+              verdict = 'SKIP', message = reason)
+
+
+# run one test script and apply the failure policy
+# pass_number identifies the board: the repeat pass
+# action is the result for the previous script of the same board;
+# the script is skipped if that was 'board' or 'station'
+# returns 'continue', 'board' (skip the rest of this board) or
+# 'station' (the station must stop)
+def runPolicyTest(name, pass_number, action, debug):
+    global current_pass
+    current_pass = pass_number
+    if 'board' == action:
+        skipTest(name, 'board failed')
+        return action
+    if 'station' == action:
+        skipTest(name, 'station stopped')
+        return action
+    if 'PASS' == runOneTest(name, debug) or on_fail in ('continue', 'module'):
+        return 'continue'
+    return on_fail
 
 
 # process a directory tree
-def processTree(top_dir, debug):
+# returns the test scripts in the order they are to be run
+def processTree(top_dir):
+    result = []
     for root, dirs, files in os.walk(top_dir):
         if verbose:
             print 'Directory:', root
@@ -97,7 +466,187 @@ def processTree(top_dir, debug):
         tests = filter(lambda f: f.startswith('test') and f.endswith('.py'), files)
         tests.sort()
         for t in tests:
-            runOneTest(os.path.join(root, t), debug)
+            result.append(os.path.join(root, t))
+    return result
+
+
+# return the name recorded in the results for a test script
+# this does not depend on how the script was reached from the
+# current directory, so that its history can be compared between runs
+def moduleName(name):
+    name = module_paths.get(name, os.path.basename(name))
+    if name.endswith('.py'):
+        return name[:-3]
+    elif name.endswith('.pyc'):
+        return name[:-4]
+    return name
+
+
+# reorder test scripts using their recorded history
+# scripts are sorted by decreasing probability of failure per second
+# of run time, so the scripts most likely to fail run first and a
+# long script is only run early if it is also likely to fail.  This
+# minimises the expected time to the first failure.
+# Scripts without history keep their original order at the end.
+def orderByHistory(tests):
+    store = ResultStore.ResultStore(result_database)
+    history = store.moduleHistory()
+    store.close()
+    def key(item):
+        (index, name) = item
+        (failure_rate, duration) = history.get(moduleName(name), (0, 0))
+        if 0 == failure_rate:
+            return (0, index)
+        return (-failure_rate / max(duration or 0, 0.001), index)
+    return [name for (index, name) in sorted(enumerate(tests), key = key)]
+
+
+# read the station configuration file
+# each non-comment line is: <station-number> name=value ...
+# e.g.  1 gpib_card=0 psu=7 dmm=22 relay=/dev/ttyUSB0
+# trace_dir=<directory> keeps the power trace recorded by the sample tests
+#   as power-<module>-<board>-<run id>-<pass>.npy
+# numeric values are converted to integers
+def readStations(file_name):
+    stations = {}
+    f = open(file_name)
+    for line in f:
+        line = line.split('#', 1)[0].strip()
+        if '' == line:
+            continue
+        fields = line.split()
+        number = int(fields[0])
+        s = {'number': number}
+        for item in fields[1:]:
+            (name, value) = item.split('=', 1)
+            try:
+                value = int(value)
+            except ValueError:
+                pass
+            s[name] = value
+        stations[number] = s
+    f.close()
+    return stations
+
+
+# check that no two stations share an instrument
+# returns an error message or None
+def checkStations(stations):
+    used = {}
+    for number in sorted(stations.iterkeys()):
+        s = stations[number]
+        card = s.get('gpib_card', 0)
+        # the same defaults as Session
+        for item in [('psu', card, s.get('psu', 5)), ('dmm', card, s.get('dmm', 22)),
+                     ('relay', s.get('relay'))]:
+            if item[-1] is None:
+                continue
+            if item in used:
+                return 'stations %d and %d share %s %s' % \
+                    (used[item], number, item[0], ':'.join([str(x) for x in item[1:]]))
+            used[item] = number
+    return None
+
+
+# worker process for one station
+# take a board (repeat pass) from the queue and run all its test
+# scripts on this station's fixture, each with stdout captured
+# the captured output is returned for the merged report
+def stationWorker(fixture, work, results, debug):
+    global station, session, cache_hits, cache_misses, timing
+    station = fixture
+    session = Session(station, debug > 0)
+    openStore()
+    running = True
+    while running:
+        item = work.get()
+        if item is None:
+            break
+        (index, pass_number, names) = item
+        cache_hits = 0
+        cache_misses = 0
+        if timing is not None:
+            timing = []
+        outputs = []
+        action = 'continue'
+        for name in names:
+            saved = sys.stdout
+            sys.stdout = StringIO.StringIO()
+            try:
+                action = runPolicyTest(name, pass_number, action, debug)
+                outputs.append((name, sys.stdout.getvalue()))
+            finally:
+                sys.stdout = saved
+        running = 'station' != action
+        results.put((index, station['number'], outputs,
+                     cache_hits, cache_misses, timing))
+    session.close()
+    closeStore()
+    results.put((None, station['number'], None, 0, 0, None))
+
+
+# add the results of a board run on a station to the report
+def reportStation(result):
+    (number, outputs, steps) = result
+    if steps is not None:
+        timing.extend(steps)
+    for (name, output) in outputs:
+        print 'STATION: %d %s' % (number, name)
+        sys.stdout.write(output)
+
+
+# run the boards on several stations in parallel
+# passes is a list of (pass number, names): each pass is one board
+# and all its test scripts are run in order on the same station
+# output is reported in pass order
+# the code cache is filled before starting the stations so that
+# each worker process inherits it
+def runStations(passes, debug, stations):
+    global cache_hits, cache_misses
+    for name in set([name for (pass_number, names) in passes for name in names]):
+        try:
+            compileTest(name)
+        except (SyntaxError, EnvironmentError):
+            pass
+    work = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    for (index, (pass_number, names)) in enumerate(passes):
+        work.put((index, pass_number, names))
+    # boards left over when all stations have stopped are discarded
+    work.cancel_join_thread()
+    workers = []
+    for number in sorted(stations.iterkeys()):
+        work.put(None)
+        p = multiprocessing.Process(target = stationWorker,
+                                    args = (stations[number], work, results, debug))
+        p.start()
+        workers.append(p)
+
+    pending = {}
+    next = 0
+    running = len(workers)
+    while running > 0 and next < len(passes):
+        (index, number, outputs, hits, misses, steps) = results.get()
+        if index is None:
+            running -= 1
+            continue
+        cache_hits += hits
+        cache_misses += misses
+        pending[index] = (number, outputs, steps)
+        while next in pending:
+            reportStation(pending.pop(next))
+            next += 1
+
+    # all stations stopped early
+    for index in range(next, len(passes)):
+        if index in pending:
+            reportStation(pending.pop(index))
+        else:
+            for name in passes[index][1]:
+                skipTest(name, 'all stations stopped')
+
+    for p in workers:
+        p.join()
 
 
 # display error and usage message; then exit
@@ -108,6 +657,27 @@ def usage(message):
     print '       --help        = this message'
     print '       --debug=n     = set global debug=level for test scripts'
     print '       --verbose     = set verbose for framework'
+    print '       --stations=n  = test n boards (repeat passes) in parallel, each'
+    print '                       running all the scripts on one station'
+    print '                       (n > 1 needs each station in --station-config)'
+    print '       --station-config=file'
+    print '                     = read station fixtures (GPIB addresses, ports) from file'
+    print '       --repeat=n    = run the complete set of test scripts n times'
+    print '       --cache=file  = keep compiled test scripts in file between runs'
+    print '       --timing=file = write the time taken by each test step to file'
+    print '       --profile=dir = write a cProfile dump for each test script to dir'
+    print '       --results=file'
+    print '                     = append a JSON Lines record for each result to file'
+    print '       --database=file'
+    print '                     = add the results to an SQLite result database'
+    print '       --board=serial = board serial number to record with the results'
+    print '       --on-fail=continue|module|board|station'
+    print '                     = after a failed test: run the next test function,'
+    print '                       the next script (default), the next board (repeat'
+    print '                       pass) or stop the station; tearDown is always run'
+    print '       --order=sorted|history'
+    print '                     = run scripts in sorted order (default) or'
+    print '                       most likely failure first using the database history'
     sys.exit(1)
 
 
@@ -119,14 +689,31 @@ def usage(message):
 #  a. First all files of the form test*.py are run in sorted order.
 #  b. Finally subdirectories are scanned in sorted order
 #     and each directory is treated as 2.
+# With --stations=n the boards (repeat passes) are taken in turn by
+# n worker processes, one per station; each runs all the scripts of a
+# board in the above order and the output is merged back per board.
 def main():
-    global verbose
+    global verbose, station, session, timing, profile_dir, result_log
+    global run_id, board, result_database, on_fail
     try:
-        opts, args = getopt.gnu_getopt(sys.argv[1:], 'hd:v', ['help', 'debug=', 'verbose'])
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'hd:vs:',
+                                       ['help', 'debug=', 'verbose',
+                                        'stations=', 'station-config=',
+                                        'repeat=', 'cache=',
+                                        'timing=', 'profile=', 'results=',
+                                        'database=', 'board=', 'order=',
+                                        'on-fail='])
     except getopt.GetoptError, err:
         usage(err)
     debug = 0
     verbose = False
+    station_count = None
+    stations = {}
+    repeat = 1
+    cache_file = None
+    timing_file = None
+    order = 'sorted'
+    run_id = '%s-%d-%d' % (socket.gethostname(), os.getpid(), time.time())
     for o, a in opts:
         if o in ('-v', '--verbose'):
             verbose = True
@@ -137,6 +724,46 @@ def main():
                 debug = int(a)
             except ValueError, e:
                 debug = 1
+        elif o in ('-s', '--stations'):
+            try:
+                station_count = int(a)
+            except ValueError, e:
+                usage('invalid station count: ' + a)
+            if station_count < 1:
+                usage('invalid station count: ' + a)
+        elif o == '--station-config':
+            try:
+                stations = readStations(a)
+            except (IOError, ValueError), e:
+                usage('cannot read station configuration: %s' % e)
+        elif o == '--repeat':
+            try:
+                repeat = int(a)
+            except ValueError, e:
+                usage('invalid repeat count: ' + a)
+        elif o == '--cache':
+            cache_file = a
+        elif o == '--timing':
+            timing_file = a
+        elif o == '--profile':
+            profile_dir = a
+        elif o == '--results':
+            try:
+                result_log = ResultLog.ResultLog(a, run = run_id)
+            except OSError, e:
+                usage('cannot open result log: %s' % e)
+        elif o == '--database':
+            result_database = a
+        elif o == '--board':
+            board = a
+        elif o == '--on-fail':
+            if a not in ('continue', 'module', 'board', 'station'):
+                usage('invalid failure policy: ' + a)
+            on_fail = a
+        elif o == '--order':
+            if a not in ('sorted', 'history'):
+                usage('invalid order: ' + a)
+            order = a
         else:
             usage('invalid option: ' + o)
 
@@ -144,11 +771,78 @@ def main():
         usage('missing arguments')
 
     # list of Python test files in sorted order
+    tests = []
     for arg in args:
         if os.path.isdir(arg):
-            processTree(arg, debug)
+            for name in processTree(arg):
+                module_paths[name] = os.path.relpath(name, arg)
+                tests.append(name)
         else:
-            runOneTest(arg, debug)
+            tests.append(arg)
+
+    if 'history' == order:
+        if result_database is None:
+            usage('--order=history requires --database')
+        try:
+            tests = orderByHistory(tests)
+        except ResultStore.sqlite3.Error, e:
+            usage('cannot read result history: %s' % e)
+    passes = [(pass_number, tests) for pass_number in range(repeat)]
+
+    if cache_file is not None:
+        loadCache(cache_file)
+
+    # create the result database before any station writes to it
+    if result_database is not None:
+        try:
+            ResultStore.ResultStore(result_database).close()
+        except ResultStore.sqlite3.Error, e:
+            usage('cannot open result database: %s' % e)
+
+    if timing_file is not None:
+        timing = []
+        installTimingHooks()
+    if profile_dir is not None and not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+
+    # use all configured stations unless a count was given
+    if station_count is None:
+        station_count = max([1] + stations.keys())
+    if station_count > 1:
+        missing = [n for n in range(1, station_count + 1) if n not in stations]
+        if [] != missing:
+            usage('--stations=%d requires --station-config with stations: %s' %
+                  (station_count, ' '.join([str(n) for n in missing])))
+    stations = dict([(n, stations.get(n, {'number': n}))
+                     for n in range(1, station_count + 1)])
+    error = checkStations(stations)
+    if error is not None:
+        usage(error)
+
+    if 1 == len(stations):
+        station = stations[1]
+        session = Session(station, debug > 0)
+        openStore()
+        action = 'continue'
+        for (pass_number, names) in passes:
+            if 'board' == action:
+                action = 'continue'
+            for name in names:
+                action = runPolicyTest(name, pass_number, action, debug)
+        session.close()
+        closeStore()
+    else:
+        runStations(passes, debug, stations)
+
+    if cache_file is not None:
+        try:
+            saveCache(cache_file)
+        except EnvironmentError, e:
+            print 'error: cannot save cache:', e
+    if verbose or cache_file is not None:
+        cacheReport()
+    if timing_file is not None:
+        saveTiming(timing_file)
 
 # execute the main program if run as a script
 if __name__ == '__main__':
@@ -0,0 +1,24 @@
+# Transport
+# -*- coding: utf-8 -*-
+# COPYRIGHT: Openmoko Inc. 2009
+# LICENSE: GPL Version 2 or later
+# DESCRIPTION: Select the GPIB implementation used by the instrument classes
+# AUTHOR: Openmoko Inc.
+
+# GPIB_TRANSPORT selects the implementation:
+#   gpib    the linux-gpib Python binding (default)
+#   sim     in-process simulated instruments (see SimGpib.py)
+#   broker  instruments shared through the broker daemon (see Broker.py),
+#           listening on the Unix socket GPIB_BROKER
+
+import os
+
+transport = os.environ.get('GPIB_TRANSPORT', 'gpib')
+
+if 'sim' == transport:
+    from SimGpib import Gpib, GpibError
+elif 'broker' == transport:
+    from Broker import Gpib, GpibError
+else:
+    from Gpib import Gpib
+    from gpib import GpibError
@@ -5,27 +5,30 @@
 # DESCRIPTION: Sample test
 # AUTHOR: Christopher Hall <hsw@openmoko.com>
 
-import Keithley
-from time import sleep
+from time import sleep, time
+import PowerRecorder
 
 #@$%^&*()sudtsffdsbm
 
 psu = None
+recorder = None
 
 def setUp():
     """Set up power supply and turn on
 
        Also put a message on the PSU LCD to warn operator"""
-    global psu
+    global psu, recorder
     #goop
     #assert False, "STOP ME"
     #raise Exception('kdfksdhfks')
     if debug:
         print 'setUp: **initialising**'
-    psu = Keithley.PSU2303()
+    psu = session.psu()
     psu.setCurrent(0.35)
     psu.setVoltage(3.876)
     psu.powerOn()
+    recorder = PowerRecorder.PowerRecorder(psu)
+    recorder.start()
     if debug:
         psu.settings()
         psu.measure()
@@ -33,14 +36,18 @@ def setUp():
 
 def tearDown():
     """Shutdown the power supply"""
-    global psu, debug
+    global psu, recorder, debug
     psu.setCurrent(0)
     psu.setVoltage(0)
     psu.powerOff()
+    if recorder is not None:
+        recorder.stop()
+        # keep the boot power trace of each board
+        recorder.saveTrace(station, __name__, board, run_id, pass_number)
+    recorder = None
     psu.messageOff()
     if debug:
         print 'tearDown: **cleanup**'
-    del psu
     psu = None
 
 def testZzz():
@@ -67,10 +74,13 @@ def test002_on():
 
 def test003_check_booted():
     """How to find out if booted?"""
-    global psu
-    for i in range(1000):
-        if debug:
-            psu.measure()
-        sleep(0.1)
-        i = psu.current
-        assert abs(i) > 0.01, "Device failed - lost power?"
+    global recorder
+    start = time()
+    lost = recorder.watch(100, 0.01)
+    w = recorder.window(start)
+    if debug:
+        print 'I: min = %.3f mA  max = %.3f mA  mean = %.3f mA  (%d samples)' % \
+            (w.min * 1000, w.max * 1000, w.mean * 1000, w.count)
+    measure('boot_current_min', w.min, 'A')
+    measure('boot_current_mean', w.mean, 'A')
+    assert [] == lost, "Device failed - lost power at %.1f s?" % (lost[0][0] - start)
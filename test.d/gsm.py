@@ -9,15 +9,32 @@
 # DESCRIPTION: test that we can use the GSM module
 # AUTHOR: Guillaume Chereau <charlie@openmoko.org>
 
+import os
 import time
 import serial
 import re
+import threading
+import Queue
 
 import tests
 
 
 ConfigurationFile = '/etc/test.d/tests.cfg'
 
+# reply to +CPBR=? : (<first>-<last>),<number length>,<text length>
+CONTACT_RANGE = re.compile(r'\((\d+)-(\d+)\),\d+,\d+')
+
+# phonebook entry : <index>,"<number>",<type>,"<text>"
+CONTACT = re.compile(r'(\d+),"(.+)",(\d+),"(.+)"')
+
+# number of phonebook entries read by each ranged +CPBR
+CONTACT_CHUNK = 50
+
+# reply to +CREG? : +CREG: <n>,<stat>[,<lac>,<ci>]
+# unlike the unsolicited +CREG: <stat>[,<lac>,<ci>] the second field
+# is not quoted
+CREG_QUERY = re.compile(r'\+CREG: \d+,(\d+)(,|$)')
+
 
 def try_loop(func, nb=5, sleep=None, msg="do the command"):
     """Try to run a function a number of time until it succeed"""
@@ -60,27 +77,230 @@ class TimeOut(ATError):
         super(TimeOut, self).__init__("Timeout")
 
 
+# Unsolicited result codes: lines the modem sends on its own, outside
+# the reply to a command.  '+CREG' and similar are also the reply to
+# their own query; such a line is only unsolicited if it does not
+# match the command in progress.
+UNSOLICITED = ['RING', '+CRING', '+CLIP', '+CCWA', '+CREG', '+CGREG',
+               '+CMTI', '+CMT', '+CDSI', '+CDS', '+CBM', '+CUSD', '+CIEV']
+
+# unsolicited result codes followed by a second line (the message)
+TWO_LINE_UNSOLICITED = ['+CMT', '+CDS', '+CBM']
+
+
+def unsolicited_name(line):
+    """return the name of the unsolicited result code, or None"""
+    for name in UNSOLICITED:
+        if line == name or line.startswith(name + ':'):
+            return name
+    return None
+
+
+def command_prefix(cmd):
+    """return the prefix of the reply lines of a command, e.g. '+CREG'"""
+    match = re.match(r'[+%$][A-Za-z0-9]+', cmd)
+    if match:
+        return match.group(0).upper()
+    return None
+
+
+def registered(stat):
+    """check a +CREG registration status: home network or roaming"""
+    return stat.strip() in ('1', '5')
+
+
 class Modem(object):
+    """Send AT commands to a modem
+
+    The modem is used synchronously until `start` is called.  After
+    that a reader thread takes all the lines the modem sends; the
+    replies to commands are passed to `read_line` and the unsolicited
+    result codes go to the subscribers and to `wait_event`.
+    """
+
+    # seconds the reader thread waits for data before checking whether
+    # it must stop
+    poll_time = 0.2
 
     def __init__(self, dev):
-        self.dev = serial.Serial(dev, 115200, rtscts=1, timeout=10)
+        # seconds to wait for each part of a reply
+        self.timeout = 10
+        self.dev = serial.Serial(dev, 115200, rtscts=1, timeout=self.timeout)
+        # data received but not yet returned by read_line or read
+        self.buffer = ''
+        # a command that takes text is waiting for the '> ' prompt
+        self.prompt = False
+        self.reader = None
+        self.running = False
+        self.error = None
+        self.replies = Queue.Queue()
+        # prefix of the reply to the command in progress
+        self.expect = None
+        self.lock = threading.Lock()
+        # seconds the modem took to start, see `wait_ready`
+        self.ready_time = None
+        # unsolicited result codes received: [(name, line)]
+        self.events = []
+        self.events_changed = threading.Condition()
+        self.subscribers = {}
+
+    def start(self):
+        """start the reader thread"""
+        if self.reader is not None:
+            return
+        self.running = True
+        self.dev.timeout = self.poll_time
+        self.reader = threading.Thread(target=self._reader)
+        self.reader.setDaemon(True)
+        self.reader.start()
+
+    def stop(self):
+        """stop the reader thread, this waits up to poll_time"""
+        if self.reader is None:
+            return
+        self.running = False
+        self.reader.join()
+        self.reader = None
+        self.dev.timeout = self.timeout
+
+    def _reader(self):
+        """the reader thread: sort the lines the modem sends"""
+        try:
+            while self.running:
+                line = self._poll_line()
+                if not line:
+                    continue
+                name = unsolicited_name(line)
+                if name is None or (self.expect and line.startswith(self.expect)):
+                    self.replies.put(line)
+                    continue
+                if name in TWO_LINE_UNSOLICITED:
+                    second = self._poll_line()
+                    if second is None:
+                        break
+                    line = '%s\n%s' % (line, second)
+                self._dispatch(name, line)
+        except Exception, e:
+            self.error = e
+            self.replies.put(None)
+
+    def _poll_line(self):
+        """receive a line in the reader thread, None once it is stopped"""
+        while self.running:
+            try:
+                return self._receive_line()
+            except TimeOut:
+                pass
+        return None
+
+    def _dispatch(self, name, line):
+        """record an unsolicited result code and pass it to the subscribers"""
+        tests.info("event : %s", repr(line))
+        with self.events_changed:
+            self.events.append((name, line))
+            self.events_changed.notifyAll()
+        for callback in list(self.subscribers.get(name, [])):
+            try:
+                callback(name, line)
+            except Exception, e:
+                tests.info("event handler for %s failed : %s", name, e)
+
+    def subscribe(self, name, callback):
+        """call callback(name, line) for each unsolicited result code name
+
+        For the two line codes (e.g. +CMT) the line contains both,
+        separated by '\n'.  The callback runs in the reader thread.
+        """
+        self.subscribers.setdefault(name, []).append(callback)
+
+    def unsubscribe(self, name, callback):
+        self.subscribers[name].remove(callback)
+
+    def mark(self):
+        """return a position in the events, see `wait_event`"""
+        with self.events_changed:
+            return len(self.events)
+
+    def wait_event(self, name, timeout=60, match=None, since=None):
+        """wait for an unsolicited result code and return its line
+
+        Parameters:
+
+        - name : e.g. '+CREG' or 'RING'
+
+        - match : optional function of the line that must be true
+
+        - since : a value from `mark`, to also accept events received
+          after that point; by default only new events are accepted
+        """
+        deadline = time.time() + timeout
+        with self.events_changed:
+            if since is None:
+                since = len(self.events)
+            while True:
+                for (n, line) in self.events[since:]:
+                    if n == name and (match is None or match(line)):
+                        return line
+                since = len(self.events)
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    tests.info("timeout waiting for %s", name)
+                    raise TimeOut()
+                self.events_changed.wait(remaining)
+
+    def fill(self):
+        """read whatever the modem has sent into the buffer
+
+        This waits for at least one byte, up to the port timeout, and
+        then takes everything that is available in a single read.
+        """
+        data = self.dev.read(max(self.dev.inWaiting(), 1))
+        if not data:
+            raise TimeOut()
+        self.buffer += data
 
     def read_line(self):
         """read one line from the modem
 
         return the line striped (with /r/n removed at the end), if we
         just receive '\r\n' then this return an empty line.
+
+        The timeout applies to each wait for more data, not to the
+        whole line.  The '> ' prompt of a command that takes text is
+        returned as the line '>'.
         """
-        ret = ''
-        while True:
-            c = self.dev.read(1)
-            if not c:
+        if self.reader is None:
+            try:
+                return self._receive_line()
+            except TimeOut:
                 tests.info("modem timeout")
-                raise TimeOut()
-            ret += c
-            if ret.endswith('\r\n'):
+                raise
+        try:
+            line = self.replies.get(True, self.timeout)
+        except Queue.Empty:
+            tests.info("modem timeout")
+            raise TimeOut()
+        if line is None:
+            raise self.error
+        return line
+
+    def _receive_line(self):
+        """read one line from the buffer, reading more as needed"""
+        start = 0
+        while True:
+            if self.prompt and self.buffer.lstrip('\r\n').startswith('> '):
+                self.prompt = False
+                self.buffer = self.buffer.lstrip('\r\n')[2:]
+                tests.info("recv : '> '")
+                return '>'
+            end = self.buffer.find('\r\n', start)
+            if end >= 0:
                 break
-        ret = ret.strip()
+            # the '\r' may already be in the buffer
+            start = max(len(self.buffer) - 1, 0)
+            self.fill()
+        ret = self.buffer[:end].strip()
+        self.buffer = self.buffer[end + 2:]
         if ret:
             tests.info("recv : %s", repr(ret))
         return ret
@@ -96,11 +316,16 @@ class Modem(object):
     def write(self, str):
         """write to the modem"""
         tests.info('send : %s', repr(str))
+        if str.upper().startswith(('AT+CMGS', 'AT+CMGW')):
+            self.prompt = True
         self.dev.write(str)
 
     def read(self, n=1):
-        """read from the modem"""
-        ret = self.dev.read(n)
+        """read from the modem, buffered data first"""
+        ret = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        if len(ret) < n:
+            ret += self.dev.read(n - len(ret))
         tests.info("recv : %s", repr(ret))
         return ret
 
@@ -119,15 +344,48 @@ class Modem(object):
           for the answer from the modem
         """
         parser = kargs.get('parser', self.parse_answer)
+        with self.lock:
+            try:
+                self._send(cmd, args)
+                ret = self.read_answer()
+            finally:
+                self.expect = None
+        return parser(cmd, ret)
 
+    def stream(self, cmd, *args):
+        """Send an AT command and yield the reply lines as they arrive
+
+        This is for commands with long multi-line replies, such as a
+        ranged +CPBR, so that they can be parsed while the modem is
+        still sending.  The lines are not parsed; the generator must be
+        consumed to the end.
+        """
+        with self.lock:
+            try:
+                self._send(cmd, args)
+                while True:
+                    line = self.read_line()
+                    if not line:
+                        continue
+                    if line == 'OK':
+                        return
+                    self.check_error(line)
+                    yield line
+            finally:
+                self.expect = None
+
+    def _send(self, cmd, args):
+        """write an AT command, the caller holds the lock"""
         full_cmd = 'AT%s' % cmd
         arg = self.as_arg(args)
         full_cmd = '%s%s' % (full_cmd, arg)
         full_cmd = '%s\r' % full_cmd
 
+        # drop anything left over from an earlier command
+        while not self.replies.empty():
+            self.replies.get()
+        self.expect = command_prefix(cmd)
         self.write(full_cmd)
-        ret = self.read_answer()
-        return parser(cmd, ret)
 
     def read_answer(self):
         """read an answer from the modem"""
@@ -139,24 +397,97 @@ class Modem(object):
             if line == 'OK':
                 break
             ret.append(line)
-
-            if line.startswith('+CME ERROR'):
-                if 'SIM PIN required' in line:
-                    raise SIMPINRequiredError()
-                raise ATError(line)
-            if line.startswith('+CMS ERROR'):
-                if 'SIM busy' in line:
-                    raise SIMBusyError()
-                raise ATError(line)
-            if line.startswith('+EXT ERROR'):
-                raise ATError(line)
-            if line.startswith('ERROR'):
-                raise ATError(line)
+            self.check_error(line)
         return ret
 
+    def check_error(self, line):
+        """raise the exception for an error result code"""
+        if line.startswith('+CME ERROR'):
+            if 'SIM PIN required' in line:
+                raise SIMPINRequiredError()
+            raise ATError(line)
+        if line.startswith('+CMS ERROR'):
+            if 'SIM busy' in line:
+                raise SIMBusyError()
+            raise ATError(line)
+        if line.startswith('+EXT ERROR'):
+            raise ATError(line)
+        if line.startswith('ERROR'):
+            raise ATError(line)
+
+    def wait_prompt(self):
+        """wait for the '> ' prompt after AT+CMGS or AT+CMGW"""
+        try:
+            while True:
+                line = self.read_line()
+                if line == '>':
+                    return
+                self.check_error(line)
+        finally:
+            self.prompt = False
+
     def reset(self):
         pass
 
+    def wait_ready(self, timeout=30):
+        """wait until the modem has started, return the time it took
+
+        The modem is ready when it sends its ready banner or answers
+        'OK' to an 'AT' probe.  A probe is sent each time nothing has
+        been received for a short while, the wait doubling from 0.1 up
+        to 1 second.  A slow modem may still answer the other probes,
+        so then the line is resynchronised before returning.
+        """
+        start = time.time()
+        deadline = start + timeout
+        delay = 0.1
+        probes = 0
+        port_timeout = self.dev.timeout
+        try:
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    tests.info("modem not ready after %g seconds", timeout)
+                    raise TimeOut()
+                self.dev.timeout = min(delay, remaining)
+                try:
+                    line = self._receive_line()
+                except TimeOut:
+                    self.write('AT\r')
+                    probes += 1
+                    delay = min(delay * 2, 1.0)
+                    continue
+                if line == 'OK':
+                    probes -= 1
+                elif 'ready' not in line.lower():
+                    continue
+                ready_time = time.time() - start
+                if probes > 0:
+                    self.dev.timeout = port_timeout
+                    self.resync()
+                return ready_time
+        finally:
+            self.dev.timeout = port_timeout
+
+    def resync(self, quiet=1.0):
+        """discard the replies to earlier commands
+
+        Everything is read until nothing has been received for quiet
+        seconds, then an 'AT' must be answered with 'OK'.
+        """
+        port_timeout = self.dev.timeout
+        self.dev.timeout = quiet
+        try:
+            while True:
+                self._receive_line()
+        except TimeOut:
+            pass
+        finally:
+            self.dev.timeout = port_timeout
+        self.write('AT\r')
+        while self._receive_line() != 'OK':
+            pass
+
     def parse_answer(self, cmd, answer):
         """Parse *most* of the AT answer messages
 
@@ -184,28 +515,37 @@ class Modem(object):
 
 class Calypso(Modem):
 
+    # seconds to hold the power and reset lines
+    power_off_time = 1
+    power_on_time = 1
+    reset_time = 1
+
+    # the longest the modem may take to start after reset
+    ready_timeout = 30
+
     def reset(self):
         """Initialize the modem before we can start sending AT commands
+
+        The time from the end of reset until the modem is ready is
+        kept in ready_time.
         """
         tests.info("turn modem off")
         #sys_dir = '/sys/devices/platform/neo1973-pm-gsm.0'
         sys_dir = '/sys/bus/platform/drivers/neo1973-pm-gsm/neo1973-pm-gsm.0'
         open('%s/power_on' % sys_dir, 'w').write('0')
-        time.sleep(1)
+        time.sleep(self.power_off_time)
         tests.info("turn modem on")
         open('%s/power_on' % sys_dir, 'w').write('1')
-        time.sleep(1)
+        time.sleep(self.power_on_time)
         tests.info("reset modem")
         open('%s/reset' % sys_dir, 'w').write('1')
-        time.sleep(1)
+        time.sleep(self.reset_time)
+        # discard anything sent before the reset
+        self.dev.flushInput()
+        self.buffer = ''
         open('%s/reset' % sys_dir, 'w').write('0')
-        time.sleep(4)
-        msg = self.read_line()
-        tests.info("got ready messages : %s", repr(msg))
-        time.sleep(2)
-        # tests.info("send empty command to calypso")
-        # self.dev.write('\r')
-        # self.dev.read()
+        self.ready_time = self.wait_ready(self.ready_timeout)
+        tests.info("modem ready after %.2f seconds", self.ready_time)
 
 
 class GSMTest(tests.Test):
@@ -213,6 +553,10 @@ class GSMTest(tests.Test):
 
     This test is supposed to work on both GTA02 using TI Calypso modem
     and on GTA03 with the Siemens MC75i modem.
+
+    If GSM_DEVICE is set that serial device is used instead, without
+    the power on and reset sequence; see gsmsim.py for a simulated
+    modem.
     """
 
     def chat(self, cmd, *args, **kargs):
@@ -234,21 +578,33 @@ class GSMTest(tests.Test):
         except IOError:
             self.conf = tests.parse_conf('./tests.cfg')
 
-        self.modem = Calypso('/dev/ttySAC0')
-        self.modem.reset()
-        self.init()
-        self.info("== Testing basics ==")
-        self.test_basics()
-        self.info("== Testing network ==")
-        self.test_network()
-        self.info("== Testing contacts ==")
-        self.test_contacts()
-        self.info("== Testing call ==")
-        self.test_call()
-        self.info("== Testing SMS ==")
-        self.test_sms()
-        self.info("== Testing PDU SMS ==")
-        self.test_pdu_sms()
+        device = os.environ.get('GSM_DEVICE')
+        if device:
+            # e.g. the simulator in gsmsim.py, it has no power control
+            self.modem = Modem(device)
+            self.modem.ready_time = self.modem.wait_ready()
+        else:
+            self.modem = Calypso('/dev/ttySAC0')
+            self.modem.reset()
+        if self.modem.ready_time is not None:
+            self.measure('modem_ready_time', self.modem.ready_time, 's')
+        self.modem.start()
+        try:
+            self.init()
+            self.info("== Testing basics ==")
+            self.test_basics()
+            self.info("== Testing network ==")
+            self.test_network()
+            self.info("== Testing contacts ==")
+            self.test_contacts()
+            self.info("== Testing call ==")
+            self.test_call()
+            self.info("== Testing SMS ==")
+            self.test_sms()
+            self.info("== Testing PDU SMS ==")
+            self.test_pdu_sms()
+        finally:
+            self.modem.stop()
 
     def init(self):
         """initialize the modem"""
@@ -285,8 +641,37 @@ class GSMTest(tests.Test):
             self._unlock_sim()
             self.chat('+CFUN=', 1, error='raise') # Turn on antenna
 
+        self.chat('+CREG=', 1) # report registration changes
+        since = self.modem.mark()
         self.chat('+COPS=', 0) # Register on a network
-        self.chat('+CREG?')  # check that we are registered
+        # check that we are registered
+        status = self.chat('+CREG?', parser=self._parse_creg)
+        if status and registered(status):
+            return
+        def registered_event(line):
+            # +CREG: <stat>[,<lac>,<ci>]
+            return registered(line.split(': ', 1)[1].split(',')[0])
+        try:
+            self.modem.wait_event('+CREG', 60, match=registered_event,
+                                  since=since)
+        except TimeOut:
+            self.fail("not registered on the network")
+
+    def _parse_creg(self, cmd, answer):
+        """return the <stat> of the +CREG? reply
+
+        A registration change reported while the query is running is
+        taken as part of the reply, so it is passed on as the
+        unsolicited result code it is.
+        """
+        stat = None
+        for line in answer:
+            match = CREG_QUERY.match(line)
+            if match and stat is None:
+                stat = match.group(1)
+            else:
+                self.modem._dispatch('+CREG', line)
+        return stat
 
     def _unlock_sim(self):
         pin = self.conf.get('SIM_PIN', None)
@@ -325,27 +710,51 @@ class GSMTest(tests.Test):
         ranges = try_loop(get_contact_range, 5, sleep=5, msg="get contact")
 
         # parse the returned value
-        r = re.compile(r'\((\d+)-(\d+)\),\d+,\d+')
-        match = r.match(ranges)
+        match = CONTACT_RANGE.match(ranges)
         self.check(match, "+CPBR=? returned a valid answer")
         if not match:
             return
         i_min, i_max = int(match.group(1)), int(match.group(2))
 
-        # Get all the contacts
-        r = re.compile(r'(\d+),"(.+)",(\d+),"(.+)"')
-        all_contacts = []
-        for index in range(i_min, i_max+1):
-            contact = self.chat('+CPBR=', index)
-            if contact:
-                match = r.match(contact)
-                self.check(match, "+CPBR=%d returned a valid answer", index)
-                i = int(match.group(1))
-                number = match.group(2)
-                type = int(match.group(3))
-                name = match.group(4)
-                all_contacts.append((name, number))
-        self.test_find_contact(all_contacts)
+        # Get all the contacts, a range at a time
+        contacts = {}
+        for first in range(i_min, i_max + 1, CONTACT_CHUNK):
+            last = min(first + CONTACT_CHUNK - 1, i_max)
+            entries, invalid = try_loop(
+                lambda: self._read_contacts(first, last),
+                5, sleep=5, msg="get contacts")
+            for name, number in entries:
+                contacts.setdefault(name, []).append(number)
+            for entry in invalid:
+                self.info("invalid phonebook entry : %s", entry)
+            self.check(not invalid, "+CPBR=%d,%d returned a valid answer",
+                       first, last)
+        self.test_find_contact(contacts)
+
+    def _read_contacts(self, first, last):
+        """read a range of the phonebook
+
+        Each entry is parsed as soon as its line arrives.  Return the
+        list of (name, number) and the list of the entries that could
+        not be parsed.
+        """
+        entries = []
+        invalid = []
+        try:
+            for line in self.modem.stream('+CPBR=', first, last):
+                if not line.startswith('+CPBR:'):
+                    continue
+                entry = line.split(': ', 1)[1].strip()
+                match = CONTACT.match(entry)
+                if match:
+                    entries.append((match.group(4), match.group(2)))
+                else:
+                    invalid.append(entry)
+        except ATError, e:
+            # some modems report an empty range as an error
+            if 'not found' not in str(e):
+                raise
+        return entries, invalid
 
     def test_find_contact(self, contacts):
         """Check that we found the contact specified in the conf file
@@ -355,25 +764,25 @@ class GSMTest(tests.Test):
 
         Parameters:
 
-        - contacts : a list of tuple (name, number) representing the
-          contacts found in the sim
+        - contacts : a dictionary mapping each name found in the sim to
+          the list of its numbers
         """
         contact = self.conf.get('SIM_CONTACT', None)
         if not contact:
             self.info('no SIM_CONTACT field in the conf file, skip test')
             return
         name, number = contact.split(':')
-        ok = name in [x[0] for x in contacts]
+        ok = name in contacts
         if not self.check(ok, 'Find contact "%s" in the SIM', name):
             return
-        ok = number in [x[1] for x in contacts if x[0] == name]
+        ok = number in contacts[name]
         self.check(ok, 'Contact "%s" has number "%s"', name, number)
 
     def _try_send_sms(self, number):
         """try to send an SMS, may raise SIMBusyError"""
         self.chat('+CMGF=', 1)  # Set text mode
         self.modem.write('AT+CMGS="%s"\r' % number)
-        self.modem.read(4)      # Wait for the '>'
+        self.modem.wait_prompt()
         self.modem.write('hello')
         self.modem.write('\x1a')
         self.modem.read_answer()
@@ -385,7 +794,7 @@ class GSMTest(tests.Test):
             '%s%s' % (y, x) for x, y in zip(number[::2], number[1::2]))
         self.chat('+CMGF=', 0)  # Set pdu mode
         self.modem.write('AT+CMGS=%d\r' % 17)
-        self.modem.read(4)       # Wait for the '>'
+        self.modem.wait_prompt()
         self.modem.write('0001000A81%s000005E8329BFD06' % pdu_number)
         self.modem.write('\x1a')
         self.modem.read_answer()
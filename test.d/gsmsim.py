@@ -0,0 +1,548 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# COPYRIGHT: Openmoko Inc. 2009
+# LICENSE: GPL Version 2 or later
+# NAME: gsm_simulator
+# BEFORE: final
+# AFTER: python_functions
+# SECTION: init norun nomenu
+# MENU: none
+# DESCRIPTION: simulated AT modem on a pseudo terminal for the gsm test
+# AUTHOR: Openmoko Inc.
+
+"""Simulated GSM modem
+
+The simulator opens a pseudo terminal and answers AT commands on its
+master side, enough of them for the gsm test: a SIM with a PIN and a
+phone book, network registration with +CREG reports, calls and
+sending SMS in text or PDU mode.  The gsm test uses it when the
+environment variable GSM_DEVICE is set to the slave side, e.g.
+
+  sim = ModemSimulator(pin='1234')
+  sim.start()
+  os.environ['GSM_DEVICE'] = sim.port
+
+The behaviour can be changed while it runs:
+
+- script : give fixed replies (or an error) to the next uses of a
+  command
+
+- fail : make the next uses of a command return an error
+
+- sim_busy : make the next SIM commands return 'SIM busy'
+
+- unsolicited : send an unsolicited result code, e.g. 'RING'
+
+- latency : seconds to wait before each reply
+
+Run on its own it prints the device to use and serves it, runs the
+gsm test against itself (--run) or times a series of commands
+(--benchmark).
+"""
+
+import os
+import sys
+import pty
+import tty
+import time
+import getopt
+import select
+import threading
+
+import tests
+
+
+# fixed replies of the commands that do not change anything
+DEFAULT_RESPONSES = {
+    '': [],
+    'Z': [],
+    'H': [],
+    'A': [],
+    '+CGMM': ['GSM SIMULATOR'],
+    '+CGMR': ['gsmsim 1.0'],
+    '+CGMI': ['Openmoko'],
+    '+CGSN': ['000000000000000'],
+    '+CMUX?': ['+CMUX: 0'],
+    '+IPR?': ['+IPR: 115200'],
+    'ICF?': ['+ICF: 3'],
+    '+ICF?': ['+ICF: 3'],
+    '+IFC?': ['+IFC: 2,2'],
+    'S3?': ['013'],
+    'S4?': ['010'],
+    'S5?': ['008'],
+    '+CSCS?': ['+CSCS: "GSM"'],
+    '+CPBS=': [],
+    '+CPBS?': ['+CPBS: "SM"'],
+    '+CLAC': ['AT%s' % c for c in
+              ['+CGMM', '+CGMR', '+CGMI', '+CGSN', '+CMUX', '+IPR', '+ICF',
+               '+IFC', '+CSCS', '+CFUN', '+CPIN', '+COPS', '+CREG', '+CPBS',
+               '+CPBR', '+CMGF', '+CMGS', '+CMEE', '+CLAC', 'D', 'H', 'A',
+               'E', 'Z', 'S3', 'S4', 'S5']],
+}
+
+# +CME ERROR codes for numeric error reports (AT+CMEE=1)
+CME_ERRORS = {
+    'operation not allowed': 3,
+    'SIM PIN required': 11,
+    'SIM busy': 14,
+    'incorrect password': 16,
+    'not found': 22,
+    'invalid index': 21,
+}
+
+# method name suffix for each form of an extended command,
+# e.g. AT+CPBR=? is handled by command_CPBR_test
+HANDLER_FORMS = {'': '', '?': '_query', '=?': '_test', '=': '_set'}
+
+# commands that use the SIM, see `sim_busy`
+SIM_COMMANDS = ['+CPIN', '+CPBR', '+CPBS', '+CPBW', '+CMGS', '+CMGW',
+                '+CMGR', '+CMGL', '+CMGD', '+CPMS']
+
+# commands whose errors are +CMS ERROR rather than +CME ERROR
+SMS_COMMANDS = ['+CMGS', '+CMGW', '+CMGR', '+CMGL', '+CMGD', '+CPMS']
+
+
+def split_command(cmd):
+    """split a command (without 'AT') into its name, form and arguments
+
+    e.g. '+CPBR=1,10' -> ('+CPBR', '=', '1,10'), 'E0' -> ('E0', '', '')
+    and 'D123;' -> ('D', '', '123;')
+    """
+    if cmd[:1] in '+%$':
+        end = 1
+        while end < len(cmd) and cmd[end].isalnum():
+            end += 1
+        name = cmd[:end].upper()
+        rest = cmd[end:]
+        for form in ('=?', '?', '='):
+            if rest.startswith(form):
+                return name, form, rest[len(form):]
+        return name, '', rest
+    if cmd[:1].upper() == 'D':
+        return 'D', '', cmd[1:]
+    return cmd.upper(), '', ''
+
+
+def arguments(text):
+    """split command arguments, removing the quotes"""
+    if not text:
+        return []
+    return [a.strip().strip('"') for a in text.split(',')]
+
+
+class ModemError(Exception):
+    """Reply to a command with an error result"""
+    pass
+
+
+class ModemSimulator(object):
+    """An AT modem on the master side of a pseudo terminal"""
+
+    def __init__(self, latency=0.0, pin=None, register_delay=0.5,
+                 own_number='0000000000'):
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.latency = latency
+        self.register_delay = register_delay
+        self.own_number = own_number
+        self.pin = pin
+        self.unlocked = pin is None
+        self.echo = True
+        self.cmee = 0
+        self.cfun = 0
+        self.creg = 0
+        self.registration = 0
+        self.cmgf = 0
+        self.phonebook = {}
+        self.phonebook_size = 250
+        self.responses = dict(DEFAULT_RESPONSES)
+        # command key -> [(lines, final result)]
+        self.scripts = {}
+        self.busy = 0
+        # every command received, every SMS sent and every number dialled
+        self.commands = []
+        self.messages = []
+        self.calls = []
+        self.message_reference = 0
+        self.stored = 0
+        # the SMS command waiting for its text, see `receive`
+        self.text_command = None
+        self.input = ''
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+        # pending delayed actions, cancelled by `stop`
+        self.timers = []
+
+    def start(self):
+        """serve the pseudo terminal in a background thread"""
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        """stop serving and cancel the pending delayed actions"""
+        self.running = False
+        for t in self.timers:
+            t.cancel()
+        self.timers = []
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def later(self, delay, function, *args):
+        """call function(*args) after delay seconds, unless stopped first"""
+        t = threading.Timer(delay, function, args)
+        t.setDaemon(True)
+        self.timers = [x for x in self.timers if x.isAlive()] + [t]
+        t.start()
+
+    def run(self):
+        while self.running:
+            r, w, x = select.select([self.master], [], [], 0.1)
+            if r:
+                self.receive(os.read(self.master, 1024))
+
+    def send(self, data):
+        """write to the modem side of the line"""
+        with self.lock:
+            os.write(self.master, data)
+
+    def reply(self, lines, final='OK'):
+        """send reply lines and a final result, after the latency"""
+        if self.latency > 0:
+            time.sleep(self.latency)
+        self.send(''.join(['\r\n%s\r\n' % l for l in lines + [final]]))
+
+    def receive(self, data):
+        """handle the bytes written by the gsm test"""
+        for c in data:
+            if self.text_command is not None:
+                # the text of an SMS, ended by ctrl-Z or cancelled by ESC
+                if self.echo:
+                    self.send(c)
+                if c == '\x1a':
+                    command, self.text_command = self.text_command, None
+                    self.execute_text(command, self.input)
+                    self.input = ''
+                elif c == '\x1b':
+                    self.text_command = None
+                    self.input = ''
+                    self.reply([])
+                else:
+                    self.input += c
+                continue
+            if c == '\n':
+                continue
+            if c != '\r':
+                self.input += c
+                continue
+            line, self.input = self.input.strip(), ''
+            if self.echo:
+                self.send(line + '\r')
+            if not line:
+                continue
+            if line.upper().startswith('AT'):
+                self.execute(line[2:])
+            else:
+                self.reply([], 'ERROR')
+
+    def error(self, command, message):
+        """format an error result as set by AT+CMEE"""
+        if command in SMS_COMMANDS:
+            kind = '+CMS ERROR'
+        else:
+            kind = '+CME ERROR'
+        if self.cmee == 0:
+            return 'ERROR'
+        if self.cmee == 1:
+            return '%s: %d' % (kind, CME_ERRORS.get(message, 100))
+        return '%s: %s' % (kind, message)
+
+    # scripting
+
+    def script(self, command, lines, final='OK', count=1):
+        """reply to the next count uses of a command with fixed lines
+
+        command is written as it is sent, without 'AT' or the
+        arguments, e.g. '+CPBR=' or '+CREG?'.  final may be an error
+        result, e.g. '+CMS ERROR: 304'.
+        """
+        self.scripts.setdefault(command.upper(), []).extend(
+            [(list(lines), final)] * count)
+
+    def fail(self, command, message, count=1):
+        """make the next count uses of a command fail, e.g. 'not found'"""
+        self.script(command, [], ModemError(message), count)
+
+    def sim_busy(self, count=1):
+        """make the next count SIM commands reply 'SIM busy'"""
+        self.busy = count
+
+    def unsolicited(self, line, delay=0):
+        """send an unsolicited result code, after delay seconds"""
+        if delay > 0:
+            self.later(delay, self.unsolicited, line)
+            return
+        self.send('\r\n%s\r\n' % line)
+
+    # commands
+
+    def execute(self, cmd):
+        """run one AT command (without the 'AT') and reply"""
+        self.commands.append(cmd)
+        name, form, args = split_command(cmd)
+        key = name + form
+        try:
+            if self.scripts.get(key):
+                lines, final = self.scripts[key].pop(0)
+                if isinstance(final, ModemError):
+                    raise final
+                return self.reply(lines, final)
+            if self.busy and name in SIM_COMMANDS:
+                self.busy -= 1
+                raise ModemError('SIM busy')
+            handler = None
+            if name[:1] == '+':
+                handler = getattr(self, 'command_%s%s' % (name[1:], HANDLER_FORMS[form]),
+                                  None)
+            if handler is not None:
+                lines = handler(arguments(args))
+            elif name == 'D':
+                self.calls.append(args.rstrip(';'))
+                lines = []
+            elif name in ('E0', 'E1'):
+                self.echo = name == 'E1'
+                lines = []
+            elif key in self.responses:
+                lines = self.responses[key]
+            else:
+                return self.reply([], 'ERROR')
+        except ModemError, e:
+            return self.reply([], self.error(name, str(e)))
+        except (ValueError, IndexError):
+            return self.reply([], 'ERROR')
+        if lines is not None:
+            self.reply(lines)
+
+    def command_CMEE_set(self, args):
+        self.cmee = int(args[0])
+        return []
+
+    def command_CFUN_query(self, args):
+        return ['+CFUN: %d' % self.cfun]
+
+    def command_CFUN_set(self, args):
+        if not self.unlocked:
+            raise ModemError('SIM PIN required')
+        self.cfun = int(args[0])
+        return []
+
+    def command_CPIN_query(self, args):
+        if self.unlocked:
+            return ['+CPIN: READY']
+        return ['+CPIN: SIM PIN']
+
+    def command_CPIN_set(self, args):
+        if self.unlocked:
+            raise ModemError('operation not allowed')
+        if args[0] != self.pin:
+            raise ModemError('incorrect password')
+        self.unlocked = True
+        return []
+
+    def command_CREG_set(self, args):
+        self.creg = int(args[0])
+        return []
+
+    def command_CREG_query(self, args):
+        return ['+CREG: %d,%d' % (self.creg, self.registration)]
+
+    def command_COPS_set(self, args):
+        if not self.unlocked:
+            raise ModemError('SIM PIN required')
+        if self.cfun != 1:
+            raise ModemError('operation not allowed')
+        if self.registration not in (1, 5):
+            self.registration = 2   # searching
+            self.later(self.register_delay, self.register)
+        return []
+
+    def command_COPS_query(self, args):
+        if self.registration in (1, 5):
+            return ['+COPS: 0,0,"GSM SIMULATOR"']
+        return ['+COPS: 0']
+
+    def register(self):
+        """complete a network registration started by +COPS"""
+        self.registration = 1
+        if self.creg:
+            self.unsolicited('+CREG: 1')
+
+    def command_CPBR_test(self, args):
+        return ['+CPBR: (1-%d),20,14' % self.phonebook_size]
+
+    def command_CPBR_set(self, args):
+        first = int(args[0])
+        last = int(args[1]) if len(args) > 1 else first
+        if first < 1 or last > self.phonebook_size or first > last:
+            raise ModemError('invalid index')
+        lines = []
+        for index in range(first, last + 1):
+            if index in self.phonebook:
+                number, name = self.phonebook[index]
+                if number.startswith('+'):
+                    kind = 145
+                else:
+                    kind = 129
+                lines.append('+CPBR: %d,"%s",%d,"%s"' % (index, number, kind, name))
+        if not lines:
+            raise ModemError('not found')
+        return lines
+
+    def command_CMGF_set(self, args):
+        self.cmgf = int(args[0])
+        return []
+
+    def command_CMGS_set(self, args):
+        """wait for the text of the message after a '> ' prompt"""
+        self.text_command = ('+CMGS', args)
+        if self.latency > 0:
+            time.sleep(self.latency)
+        self.send('\r\n> ')
+        return None
+
+    def execute_text(self, command, text):
+        name, args = command
+        self.message_reference += 1
+        if self.cmgf == 1:
+            number = args[0]
+        else:
+            number = None
+        self.messages.append((number, text))
+        self.reply(['+CMGS: %d' % self.message_reference])
+        if number == self.own_number:
+            self.stored += 1
+            self.unsolicited('+CMTI: "SM",%d' % self.stored, 0.1)
+
+
+def fill_phonebook(sim, conf):
+    """put the SIM_CONTACT of a configuration in the phonebook"""
+    contact = conf.get('SIM_CONTACT', None)
+    if contact:
+        name, number = contact.split(':')
+        sim.phonebook[1] = (number, name)
+
+
+def benchmark(sim, count):
+    """time a series of commands through gsm.Modem"""
+    import gsm
+    modem = gsm.Modem(sim.port)
+    modem.start()
+    modem.chat('E0')
+    out = tests.out
+    tests.out = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        for i in range(count):
+            modem.chat('+CGMM')
+        elapsed = time.time() - start
+    finally:
+        tests.out.close()
+        tests.out = out
+    modem.stop()
+    print 'commands: %d  time: %.3f s  rate: %.0f/s' % (
+        count, elapsed, count / elapsed)
+
+
+def run_test(sim):
+    """run the gsm test against the simulator
+
+    The operator confirmations are answered from the simulator state.
+    """
+    import gsm
+
+    class SimulatedGSMTest(gsm.GSMTest):
+
+        def operator_confirm(self, msg, *args):
+            if 'ringing' in msg:
+                ok = sim.calls != []
+            elif 'SMS' in msg:
+                ok = [m for m in sim.messages if 'hello' in m[1]] != []
+            else:
+                ok = True
+            return self.check(ok, msg + ' (simulated)', *args)
+
+    os.environ['GSM_DEVICE'] = sim.port
+    return SimulatedGSMTest().main()
+
+
+def usage(message):
+    """display error and usage message; then exit"""
+    if message is not None:
+        print 'error:', message
+    print 'usage:', sys.argv[0], '<options>'
+    print '       --help            = this message'
+    print '       --latency=seconds = delay before each reply'
+    print '       --pin=pin         = the SIM needs a PIN (default: SIM_PIN of tests.cfg)'
+    print '       --run             = run the gsm test against the simulator'
+    print '       --benchmark=count = time count commands'
+    sys.exit(1)
+
+
+def main():
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'hl:p:rb:',
+                                       ['help', 'latency=', 'pin=', 'run',
+                                        'benchmark='])
+    except getopt.GetoptError, err:
+        usage(err)
+    try:
+        conf = tests.parse_conf('/etc/test.d/tests.cfg')
+    except IOError:
+        conf = tests.parse_conf(os.path.join(os.path.dirname(__file__), 'tests.cfg'))
+    latency = 0.0
+    pin = conf.get('SIM_PIN', None)
+    run = False
+    count = None
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            usage(None)
+        elif o in ('-l', '--latency'):
+            latency = float(a)
+        elif o in ('-p', '--pin'):
+            pin = a
+        elif o in ('-r', '--run'):
+            run = True
+        elif o in ('-b', '--benchmark'):
+            count = int(a)
+        else:
+            usage('invalid option: ' + o)
+    if args:
+        usage('unexpected arguments')
+
+    sim = ModemSimulator(latency=latency, pin=pin,
+                         own_number=conf.get('CALLABLE_NUMBER', '0000000000'))
+    fill_phonebook(sim, conf)
+    sim.start()
+    if count is not None:
+        benchmark(sim, count)
+    elif run:
+        status = run_test(sim)
+        sim.stop()
+        sys.exit(status)
+    else:
+        print 'GSM_DEVICE=%s' % sim.port
+        sys.stdout.flush()
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+    sim.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -18,14 +18,45 @@ bash.
 
 import os
 import sys
+import time
+import json
 
 # The output stream for all tests
 out = sys.stdout
 
+# The JSON Lines result stream (file descriptor), None if not used.
+# It is opened automatically if TEST_RESULT_LOG is set.
+results = None
+
+# The board serial number added to each result record (TEST_BOARD)
+board = os.environ.get('TEST_BOARD')
+
+
+def open_results(file):
+    """Append a JSON record for every result to a file
+
+    Each record is written with a single unbuffered write on a file
+    opened in append mode, so several tests can share the same file
+    and a collector can read it while the tests are running.
+    """
+    global results
+    results = os.open(file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+
+
+def record(**items):
+    """Append one record to the result stream, if there is one"""
+    if results is None:
+        return
+    items['time'] = time.time()
+    if board is not None:
+        items.setdefault('board', board)
+    os.write(results, json.dumps(items, sort_keys=True) + '\n')
+
 
 def info(msg, *args):
     """Print an INFO message to the output"""
     print >> out, "INFO: %s" % (msg % args)
+    record(type='info', message=msg % args)
 
 
 def parse_conf(file):
@@ -56,6 +87,7 @@ class Test(object):
         """
         self.fail_count = 0
         self.total_count = 0
+        self.name = os.path.splitext(os.path.basename(sys.argv[0]))[0]
 
     def run(self):
         """Override this method to write your own tests"""
@@ -67,11 +99,17 @@ class Test(object):
         It performs the test, print the PASS or FAIL message, and then
         return the exit value (0 for success, 1 for failure).
         """
+        self.start_time = time.time()
         try:
             self.run()
         except Exception, e:
             self.fail("Got exception : %s", e)
 
+        self._record(type='test',
+                     verdict='PASS' if self.fail_count == 0 else 'FAIL',
+                     failed=self.fail_count, total=self.total_count,
+                     start=self.start_time)
+
         if self.fail_count == 0:
             print >> out, "PASS: test successful"
         elif self.fail_count == 1:
@@ -86,11 +124,23 @@ class Test(object):
         ret = self.main()
         sys.exit(ret)
 
+    def _record(self, **items):
+        """Add a record for this test to the result stream"""
+        items.setdefault('module', self.name)
+        items.setdefault('test', self.name)
+        record(**items)
+
+    def _record_step(self, verdict, msg, args):
+        """Add the record of a check, identified by its message format"""
+        self._record(type='step', verdict=verdict, message=msg % args,
+                     step=msg, test='%s.%s' % (self.name, msg))
+
     def fail(self, msg, *args):
         """Call this method if something fails"""
         print >> out, "FAIL: %s" % (msg % args)
         self.fail_count += 1
         self.total_count += 1
+        self._record_step('FAIL', msg, args)
         return False
 
     def check(self, cond, msg, *args):
@@ -102,7 +152,16 @@ class Test(object):
 
     def info(self, msg, *args):
         """Call this method to pass info"""
-        info(msg, *args)
+        print >> out, "INFO: %s" % (msg % args)
+        self._record(type='info', message=msg % args)
+
+    def measure(self, name, value, unit=None):
+        """Report a measured value"""
+        if unit is None:
+            print >> out, "INFO: %s = %s" % (name, value)
+        else:
+            print >> out, "INFO: %s = %s %s" % (name, value, unit)
+        self._record(type='measure', name=name, value=value, unit=unit)
 
     def operator_confirm(self, msg, *args):
         """Ask a yes/no question to the operator, fail if the answer is no"""
@@ -122,9 +181,14 @@ class Test(object):
         """Pass a test"""
         print >> out, "PASS: %s" % (msg % args)
         self.total_count += 1
+        self._record_step('PASS', msg, args)
         return True
 
 
+if os.environ.get('TEST_RESULT_LOG'):
+    open_results(os.environ['TEST_RESULT_LOG'])
+
+
 if __name__ == '__main__':
 
     class MyTest(Test):